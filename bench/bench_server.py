@@ -0,0 +1,216 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from multiprocessing import Process, Queue
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'metrics_server')
+sys.path.insert(0, SERVER_DIR)
+from metrics_client import MetricsClient
+from wal import segment_paths
+
+# Constants
+SERVER_HOST = 'localhost'
+SERVER_PORT = 9998
+NUM_WRITERS = 4
+NUM_READERS = 2
+NUM_PARTITIONS = 32
+NUM_TOPICS = 4				# writers are spread over this many offsets namespaces
+DURATION_SEC = 10.0
+MSGS_PER_SEC = 5000			# per partition, for the synthetic offsets
+READ_VARS = ['msgsin', 'msgsout', 'lags', 'wait_time', 'vm', 'msgsize', 'bytesin', 'bytesout', 'jmx']
+KINDS = ['offsets', 'jmx', 'bytesin']
+
+
+class SyntheticSamples(object):
+	# Samples shaped like the monitors' output: offsets of num_partitions
+	# partitions advancing at a steady rate, JmxMonitor rates and tcpdump
+	# throughputs, one kind after another
+	def __init__(self, writer_id, num_partitions, seed):
+		self.rand = random.Random(seed)
+		self.var = 'offsets/topic{}/group'.format(writer_id % NUM_TOPICS)
+		self.latest = [self.rand.randint(0, 10 ** 9) for p in range(num_partitions)]
+		self.committed = list(self.latest)
+		self.last_time = time.time()
+		self.i = 0
+
+	def next(self):
+		kind = KINDS[self.i % len(KINDS)]
+		self.i += 1
+		if kind == 'jmx':
+			msgsin = self.rand.uniform(1000, 50000)
+			return {'jmx': {'msgsin_1min': msgsin, 'bytesin_1min': msgsin * self.rand.uniform(100, 1000),
+							'bytesout_1min': msgsin * self.rand.uniform(100, 2000)}}
+		if kind == 'bytesin':
+			return {'bytesin': self.rand.uniform(10 ** 5, 10 ** 8)}
+		now = time.time()
+		produced = int(MSGS_PER_SEC * (now - self.last_time))
+		self.last_time = now
+		partitions = {}
+		for p in range(len(self.latest)):
+			self.latest[p] += int(produced * self.rand.uniform(0.5, 1.5))
+			self.committed[p] = min(self.latest[p], self.committed[p] + int(produced * self.rand.uniform(0.3, 1.7)))
+			partitions['partition_' + str(p)] = {'latest': self.latest[p], 'committed': self.committed[p],
+												 'lag': self.latest[p] - self.committed[p], 'timestamp': now}
+		return {self.var: partitions}
+
+
+def read_captured(path):
+	# set requests of a request log: a segment directory, a segment file
+	# ('<timestamp> <request>' lines) or a plain file of requests
+	paths = segment_paths(path) if os.path.isdir(path) else [path]
+	reqs = []
+	for p in paths:
+		with open(p) as f:
+			for line in f:
+				(ts, sep, req) = line.rstrip('\n').partition(' ')
+				try:
+					float(ts)
+				except ValueError:
+					req = line.rstrip('\n')
+				if req.startswith('set '):
+					try:
+						reqs.append(json.loads(req[4:])['args'])
+					except ValueError:
+						continue	# a line cut short by a crash
+	return reqs
+
+def writer(writer_id, host, port, binary, num_partitions, captured, duration_sec, results):
+	client = MetricsClient(host, port, binary=binary)
+	samples = SyntheticSamples(writer_id, num_partitions, writer_id)
+	latencies = []
+	end = time.time() + duration_sec
+	i = writer_id
+	while time.time() < end:
+		if captured is not None:
+			vals = captured[i % len(captured)]
+			i += 1
+		else:
+			vals = samples.next()
+		start = time.time()
+		client.set(vals)
+		if not client.flush():
+			break
+		latencies.append(time.time() - start)
+	client.close()
+	results.put(('set', latencies))
+
+def reader(host, port, binary, conditional, duration_sec, results):
+	client = MetricsClient(host, port, binary=binary)
+	latencies = []
+	version = None
+	end = time.time() + duration_sec
+	while time.time() < end:
+		start = time.time()
+		if conditional:
+			resp = client.get_changed(READ_VARS, version)
+			if resp is None:
+				break
+			version = resp[0]
+		elif client.get(READ_VARS) is None:
+			break
+		latencies.append(time.time() - start)
+	client.close()
+	results.put(('get', latencies))
+
+def start_server(port, mode, log_dir):
+	proc = subprocess.Popen([sys.executable, 'metrics_server.py', '-p', str(port), '-m', mode,
+							 '-l', log_dir, '--log_level', 'warning'], cwd=SERVER_DIR)
+	for i in range(100):
+		try:
+			socket.create_connection((SERVER_HOST, port), 1).close()
+			return proc
+		except socket.error:
+			time.sleep(0.1)
+	proc.kill()
+	sys.exit('Server did not start on port {}'.format(port))
+
+def rss_mb(pid):
+	try:
+		with open('/proc/{}/status'.format(pid)) as f:
+			for line in f:
+				if line.startswith('VmRSS:'):
+					return int(line.split()[1]) / 1024.0
+	except IOError:
+		pass
+	return None
+
+def run(host, port, binary, conditional, num_writers, num_readers, num_partitions, captured, duration_sec):
+	results = Queue()
+	procs = [Process(target=writer, args=(i, host, port, binary, num_partitions, captured, duration_sec, results))
+			 for i in range(num_writers)] + \
+		[Process(target=reader, args=(host, port, binary, conditional, duration_sec, results))
+		 for i in range(num_readers)]
+	for p in procs:
+		p.start()
+	latencies = {'set': [], 'get': []}
+	for p in procs:
+		(cmd, l) = results.get()
+		latencies[cmd] += l
+	for p in procs:
+		p.join()
+	return latencies
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-s', '--server_host', type=str,
+						help='benchmark a running server instead of starting one')
+	parser.add_argument('-p', '--server_port', default=SERVER_PORT, type=int)
+	parser.add_argument('-m', '--mode', default='thread', choices=['thread', 'event'],
+						help='mode of the server started by the benchmark')
+	parser.add_argument('--server_pid', type=int, help='pid of a running server, for its RSS')
+	parser.add_argument('-b', '--binary', action='store_true',
+						help='clients use the binary protocol instead of text')
+	parser.add_argument('-g', '--conditional_get', action='store_true',
+						help='readers only fetch values changed since their last get')
+	parser.add_argument('-w', '--writers', default=NUM_WRITERS, type=int)
+	parser.add_argument('-r', '--readers', default=NUM_READERS, type=int)
+	parser.add_argument('-n', '--partitions', default=NUM_PARTITIONS, type=int,
+						help='partitions per synthetic offsets sample')
+	parser.add_argument('-c', '--captured', type=str,
+						help='replay the set requests of a request log instead of synthetic samples')
+	parser.add_argument('-d', '--duration_sec', default=DURATION_SEC, type=float)
+	args = parser.parse_args()
+	print('Arguments: {}'.format(vars(args)))
+
+	captured = read_captured(args.captured) if args.captured is not None else None
+	if captured is not None and len(captured) == 0:
+		sys.exit('No set requests in {}'.format(args.captured))
+
+	(server, log_dir, pid) = (None, None, args.server_pid)
+	host = args.server_host if args.server_host is not None else SERVER_HOST
+	if args.server_host is None:
+		log_dir = tempfile.mkdtemp(prefix='bench_server_')
+		server = start_server(args.server_port, args.mode, log_dir)
+		pid = server.pid
+	try:
+		rss_before = rss_mb(pid) if pid is not None else None
+		latencies = run(host, args.server_port, args.binary, args.conditional_get, args.writers, args.readers, args.partitions,
+						captured, args.duration_sec)
+		rss_after = rss_mb(pid) if pid is not None else None
+		stats = MetricsClient(host, args.server_port).request('stats', None)
+	finally:
+		if server is not None:
+			server.send_signal(signal.SIGINT)
+			server.wait()
+			shutil.rmtree(log_dir, ignore_errors=True)
+
+	for cmd in ['set', 'get']:
+		l = np.array(latencies[cmd]) * 1000.0
+		if 0 < len(l):
+			print('{}: {:9.0f} requests/s  latency p50 {:.3f} ms  p99 {:.3f} ms  max {:.3f} ms'.format(
+				cmd, len(l) / args.duration_sec, np.percentile(l, 50), np.percentile(l, 99), l.max()))
+	if stats is not None:
+		print('derived values (server side):')
+		for (name, s) in sorted(stats['derived_sec'].items()):
+			print('  {:12s} {:8d} computed, mean {:.3f} ms'.format(name, s['count'], 1000.0 * s['mean']))
+	if rss_after is not None:
+		print('server RSS: {:.1f} MB before, {:.1f} MB after'.format(rss_before, rss_after))
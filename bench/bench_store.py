@@ -0,0 +1,89 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+from threading import Lock, Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'metrics_server'))
+from store import ValueStore
+
+# Constants
+NUM_WRITERS = 4
+NUM_READERS = 4
+NUM_VARS = 8				# variables written together by every set
+NUM_BACKGROUND_VARS = 200	# other variables in the store
+DURATION_SEC = 3.0
+
+
+class LockedDictStore(object):
+	# Previous implementation, kept as the reference: one lock taken per
+	# variable on writes and unlocked reads
+	def __init__(self):
+		self.vals = {}
+		self.lock = Lock()
+
+	def update(self, vals):
+		for var in vals:
+			with self.lock:
+				self.vals[var] = vals[var]
+
+	def get(self, vars):
+		return dict((var, self.vals[var] if var in self.vals else None) for var in vars)
+
+
+def writer(store, writer_id, vars, stop, counts):
+	seq = 0
+	while not stop:
+		seq += 1
+		store.update(dict((var, (writer_id, seq)) for var in vars))
+	counts[writer_id] = seq
+
+def reader(store, reader_id, vars, stop, counts, torn, latencies):
+	# every set writes the same value to all vars, so a consistent view
+	# holds a single distinct value
+	n = 0
+	while not stop:
+		start = time.time()
+		vals = store.get(vars)
+		if n % 64 == 0:
+			latencies.append(time.time() - start)
+		if 1 < len(set(vals.values())):
+			torn[reader_id] += 1
+		n += 1
+	counts[reader_id] = n
+
+def run(store, num_writers, num_readers, num_vars, num_background_vars, duration_sec):
+	vars = ['var{}'.format(i) for i in range(num_vars)]
+	store.update(dict(('background{}'.format(i), i) for i in range(num_background_vars)))
+	store.update(dict((var, (-1, 0)) for var in vars))
+	stop = []
+	(writes, reads, torn, latencies) = ([0] * num_writers, [0] * num_readers, [0] * num_readers, [])
+	threads = [Thread(target=writer, args=(store, i, vars, stop, writes)) for i in range(num_writers)] + \
+		[Thread(target=reader, args=(store, i, vars, stop, reads, torn, latencies)) for i in range(num_readers)]
+	for t in threads:
+		t.start()
+	time.sleep(duration_sec)
+	stop.append(True)
+	for t in threads:
+		t.join()
+	return (sum(writes) / duration_sec, sum(reads) / duration_sec, sum(torn),
+			np.percentile(latencies, [50, 99]) * 1e6 if 0 < len(latencies) else [0.0, 0.0])
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-w', '--writers', default=NUM_WRITERS, type=int)
+	parser.add_argument('-r', '--readers', default=NUM_READERS, type=int)
+	parser.add_argument('-v', '--vars', default=NUM_VARS, type=int, help='variables per set')
+	parser.add_argument('-b', '--background_vars', default=NUM_BACKGROUND_VARS, type=int,
+						help='other variables in the store')
+	parser.add_argument('-d', '--duration_sec', default=DURATION_SEC, type=float)
+	args = parser.parse_args()
+	print('Arguments: {}'.format(vars(args)))
+
+	print('store size: {} variables'.format(args.vars + args.background_vars))
+	for (name, store) in [('locked dict', LockedDictStore()), ('snapshots', ValueStore())]:
+		(sets, gets, torn, (p50, p99)) = run(store, args.writers, args.readers, args.vars, args.background_vars,
+											 args.duration_sec)
+		print('{:14s} {:9.0f} sets/s {:9.0f} gets/s  get p50 {:6.1f} us p99 {:7.1f} us  torn gets: {}'.
+			  format(name + ':', sets, gets, p50, p99, torn))
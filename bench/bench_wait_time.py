@@ -0,0 +1,146 @@
+import argparse
+import os
+import random
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'metrics_server'))
+from derived_values import WaitTime
+
+# Constants
+NUM_PARTITIONS = 8
+NUM_SAMPLES = 40
+MSGS_PER_SEC = 20000		# per partition
+INTERVAL_SEC = 3
+
+
+class InterpWaitTime(object):
+	# Previous implementation, kept as the reference: it interpolates a
+	# timestamp for every single offset between two samples
+	def __init__(self):
+		self._latest = {}
+		self._committed = {}
+
+	def compute(self, partitions):
+		delta_timestamps = np.array([])
+
+		latest = self._latest
+		committed = self._committed
+
+		for p in partitions:
+			latest_offset = partitions[p]['latest']
+			committed_offset = partitions[p]['committed']
+			timestamp = partitions[p]['timestamp']
+
+			if p not in latest:
+				latest[p] = {'offset': np.array([]), 'timestamp': np.array([])}
+			if p not in committed:
+				committed[p] = {'offset': np.array([]), 'timestamp': np.array([])}
+
+			if (latest_offset is not None) and (timestamp is not None):
+				latest[p]['offset'] = np.append(latest[p]['offset'], latest_offset)
+				latest[p]['timestamp'] = np.append(latest[p]['timestamp'], timestamp)
+			if (committed_offset is not None) and (timestamp is not None):
+				committed[p]['offset'] = np.append(committed[p]['offset'], committed_offset)
+				committed[p]['timestamp'] = np.append(committed[p]['timestamp'], timestamp)
+
+			if len(latest[p]['offset']) <= 1 or len(committed[p]['offset']) <= 1:
+				continue
+
+			latest_offset_range = np.arange(latest[p]['offset'][-2], latest[p]['offset'][-1] + 1)
+			latest_interp = np.interp(latest_offset_range,
+									  [latest[p]['offset'][-2], latest[p]['offset'][-1]],
+									  [latest[p]['timestamp'][-2], latest[p]['timestamp'][-1]])
+			latest[p]['offset'] = np.append(latest[p]['offset'][:-2], latest_offset_range)
+			latest[p]['timestamp'] = np.append(latest[p]['timestamp'][:-2], latest_interp)
+
+			committed_offset_range = np.arange(committed[p]['offset'][-2], committed_offset + 1)
+			committed_interp = np.interp(committed_offset_range,
+										 [committed[p]['offset'][-2], committed_offset],
+										 [committed[p]['timestamp'][-2], timestamp])
+			committed[p]['offset'] = np.append(committed[p]['offset'][:-2], committed_offset_range)
+			committed[p]['timestamp'] = np.append(committed[p]['timestamp'][:-2], committed_interp)
+
+			min_committed = committed[p]['offset'][0]
+			max_committed = committed[p]['offset'][-1]
+			common_offsets = latest[p]['offset'][(min_committed <= latest[p]['offset']) & (latest[p]['offset'] <= max_committed)]
+
+			latest_timestamps = latest[p]['timestamp'][(common_offsets[0] <= latest[p]['offset']) & (latest[p]['offset'] <= common_offsets[-1])]
+			committed_timestamps = committed[p]['timestamp'][(common_offsets[0] <= committed[p]['offset']) & (committed[p]['offset'] <= common_offsets[-1])]
+			delta = [(committed_timestamps[i] - latest_timestamps[i]) for i in range(0, len(committed_timestamps))]
+			delta_timestamps = np.append(delta_timestamps, delta)
+
+			filter = common_offsets[-1] <= latest[p]['offset']
+			latest[p]['offset'] = latest[p]['offset'][filter]
+			latest[p]['timestamp'] = latest[p]['timestamp'][filter]
+			filter = common_offsets[-1] <= committed[p]['offset']
+			committed[p]['offset'] = committed[p]['offset'][filter]
+			committed[p]['timestamp'] = committed[p]['timestamp'][filter]
+
+		return ('wait_time', np.mean(delta_timestamps) if 0 < len(delta_timestamps) else None)
+
+
+def generate_samples(num_partitions, num_samples, msgs_per_sec, interval_sec, seed):
+	# Offsets payloads of a topic whose consumer alternately falls behind and
+	# catches up; it starts caught up, as the reference implementation requires
+	rand = random.Random(seed)
+	latest = [rand.randint(0, 1000000) for p in range(num_partitions)]
+	committed = list(latest)
+	timestamp = 1500000000.0
+	samples = []
+	for i in range(num_samples):
+		partitions = {}
+		for p in range(num_partitions):
+			partitions['partition_' + str(p)] = {'latest': latest[p], 'committed': committed[p],
+												 'lag': latest[p] - committed[p], 'timestamp': timestamp}
+		samples.append(partitions)
+		timestamp += interval_sec * rand.uniform(0.9, 1.1)
+		for p in range(num_partitions):
+			produced = int(msgs_per_sec * interval_sec * rand.uniform(0.5, 1.5))
+			if rand.random() < 0.2:
+				produced = 0	# idle producer: the latest offset does not move
+			latest[p] += produced
+			consumed = int(msgs_per_sec * interval_sec * rand.uniform(0.3, 1.7))
+			committed[p] = min(latest[p], committed[p] + consumed)
+	return samples
+
+def run(wait_time, samples):
+	results = []
+	start = time.time()
+	for partitions in samples:
+		results.append(wait_time.compute(partitions)[1])
+	return (results, time.time() - start)
+
+def same_results(a, b):
+	for (x, y) in zip(a, b):
+		if (x is None) != (y is None):
+			return False
+		if x is not None and not np.isclose(x, y, rtol=1e-9, atol=1e-6):
+			return False
+	return len(a) == len(b)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-p', '--partitions', default=NUM_PARTITIONS, type=int)
+	parser.add_argument('-n', '--samples', default=NUM_SAMPLES, type=int)
+	parser.add_argument('-r', '--msgs_per_sec', default=MSGS_PER_SEC, type=int,
+						help='messages per second per partition')
+	parser.add_argument('-i', '--interval_sec', default=INTERVAL_SEC, type=float)
+	parser.add_argument('-s', '--seed', default=0, type=int)
+	args = parser.parse_args()
+	print('Arguments: {}'.format(vars(args)))
+
+	samples = generate_samples(args.partitions, args.samples, args.msgs_per_sec,
+							   args.interval_sec, args.seed)
+	(expected, interp_sec) = run(InterpWaitTime(), samples)
+	(actual, analytic_sec) = run(WaitTime(), samples)
+
+	print('interpolation: {:.3f} ms/sample'.format(1000.0 * interp_sec / len(samples)))
+	print('analytic:      {:.3f} ms/sample'.format(1000.0 * analytic_sec / len(samples)))
+	print('speedup:       {:.1f}x'.format(interp_sec / analytic_sec))
+	if not same_results(expected, actual):
+		for (i, (x, y)) in enumerate(zip(expected, actual)):
+			print('{}: {} vs. {}'.format(i, x, y))
+		sys.exit('Results differ from the interpolation implementation')
+	print('Results match the interpolation implementation')
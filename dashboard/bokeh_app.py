@@ -1,22 +1,20 @@
-import json
 import random
-import socket
+import sys
+import time
 from datetime import datetime
 from bokeh.layouts import column, layout
 from bokeh.plotting import curdoc, figure
-from timeseries_plots import MsgsPlot, BytesPlot, VmPlot, LagsPlot, MsgsizePlot, WaitTimePlot
+from metrics_hub import get_hub
+from timeseries_plots import MsgsPlot, BytesPlot, VmPlot, LagsPlot, MsgsizePlot, WaitTimePlot, \
+	DISPLAY_TIME_FORMAT
 
 METRICS_SERVER_IP = 'localhost'
 METRICS_SERVER_PORT = 9999
-BUFFER_SIZE = 1024
 UPDATE_INTERVAL_MSEC = 3000
+BACKFILL_SEC = 3600
+PUSH_UPDATES = '--push' in sys.argv[1:]	# bokeh serve bokeh_app.py --args --push
 PLOTS = [[MsgsPlot(), VmPlot()], [LagsPlot(), MsgsizePlot()], [WaitTimePlot()]]
 
-def connect(ip, port):
-	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-	sock.connect((ip, port))
-	return sock
-
 def flatten_list(list):
 	flat_list = []
 	for sublist in list:
@@ -30,30 +28,30 @@ def get_requests(plots):
 	requests = flatten_list([plot.get_requests() for plot in flat_plots])
 	return list(set(requests))
 
-def update_plots():
+def backfill_plots():
+	# Fill the plots with the server-side history so a new session does not start empty
+	history = hub.range(requests, time.time() - BACKFILL_SEC, UPDATE_INTERVAL_MSEC / 1000.0)
+	if history is not None:
+		for plot in flat_plots:
+			plot.backfill(history)
+
+def plot_data(data):
+	# all plots change in one batch, sent to the browser as a single message
+	curdoc().hold('combine')
 	now = datetime.now()
 	time = [now]
-	display_time = [now.strftime("%m-%d-%Y %H:%M:%S.%f")]
-
-	args = {'args': requests}
-	req = 'get ' + json.dumps(args)
-	sock.send(req)
-	resp = sock.recv(BUFFER_SIZE)
-	resp = resp[-1] if resp.endswith('\n') else resp
+	display_time = [now.strftime(DISPLAY_TIME_FORMAT)]
 
 	display_data = []
-	if resp.startswith('ok'):
-		data = json.loads(resp[3:])
-		for plot in flat_plots:
-			d = plot.update_plot(time, display_time, data)
-			display_data = display_data + d
-
+	for plot in flat_plots:
+		d = plot.update_plot(time, display_time, data)
+		display_data = display_data + d
+	curdoc().unhold()
 	# print ', '.join(str(x) for x in display_data)
-	print resp
 
 
-print('\tConnecting to: {}:{}'.format(METRICS_SERVER_IP, METRICS_SERVER_PORT))
-sock = connect(METRICS_SERVER_IP, METRICS_SERVER_PORT)
+# one connection and one query per interval for all sessions of this server
+hub = get_hub(METRICS_SERVER_IP, METRICS_SERVER_PORT, UPDATE_INTERVAL_MSEC / 1000.0, PUSH_UPDATES)
 
 requests = get_requests(PLOTS)
 print('\tMaking requests to: {}'.format(requests))
@@ -61,5 +59,6 @@ flat_plots = flatten_list(PLOTS)
 
 l = layout([map(lambda p: p.create_plot(), plot) for plot in PLOTS])
 curdoc().add_root(l)
-curdoc().add_periodic_callback(update_plots, UPDATE_INTERVAL_MSEC)
+backfill_plots()
+hub.register(curdoc(), requests, plot_data)
 curdoc().title = "Kafka Metrics Visualizer"
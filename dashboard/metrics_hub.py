@@ -0,0 +1,124 @@
+import os
+import socket
+import sys
+import time
+from functools import partial
+from threading import Lock, Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'metrics_server'))
+from metrics_client import MetricsClient
+
+# Constants
+IDLE_SEC = 0.5				# wait while no session is open or the server is down
+
+
+class MetricsHub(Thread):
+	# One per Bokeh server process, shared by all of its sessions: a single
+	# connection fetches the union of the sessions' variables once per interval
+	# (or follows a single subscription in push mode), and every session gets
+	# the same decoded result on its own document's event loop. Both
+	# connections use the binary protocol, which is cheaper to decode.
+	def __init__(self, host, port, interval_sec, push=False):
+		Thread.__init__(self, name='MetricsHub')
+		self.daemon = True
+		self.interval_sec = interval_sec
+		self.push = push
+		self.client = MetricsClient(host, port, binary=True)		# polls and backfills
+		self.client_lock = Lock()
+		self.feed = MetricsClient(host, port, binary=True)		# subscription (push mode)
+		self.feed_lock = Lock()
+		self.sessions = {}	# doc -> (vars, callback)
+		self.lock = Lock()
+		self.start()
+
+	def register(self, doc, vars, callback):
+		# callback(data) runs on doc's event loop after every fetch or update
+		with self.lock:
+			self.sessions[doc] = (set(vars), callback)
+		doc.on_session_destroyed(lambda session_context: self.unregister(doc))
+		if self.push:
+			self.subscribe_more(vars)
+
+	def unregister(self, doc):
+		with self.lock:
+			self.sessions.pop(doc, None)
+
+	def wanted(self):
+		with self.lock:
+			return sorted(set().union(*[vars for (vars, callback) in self.sessions.values()]))
+
+	def range(self, vars, since, step):
+		with self.client_lock:
+			return self.client.range(vars, since, step)
+
+	def fan_out(self, data):
+		with self.lock:
+			sessions = self.sessions.items()
+		for (doc, (vars, callback)) in sessions:
+			doc.add_next_tick_callback(partial(callback, data))
+
+	def run(self):
+		if self.push:
+			self.follow()
+		else:
+			self.poll()
+
+	def poll(self):
+		# Conditional gets: the server answers 'unchanged' while none of the
+		# variables changed, and the sessions get the previous data again
+		next_poll = time.time()
+		(last_vars, version, data) = (None, None, None)
+		while True:
+			vars = self.wanted()
+			if vars != last_vars:
+				(last_vars, version, data) = (vars, None, None)
+			if 0 < len(vars):
+				with self.client_lock:
+					resp = self.client.get_changed(vars, version)
+				if resp is not None:
+					(version, changed) = resp
+					data = changed if changed is not None else data
+					self.fan_out(data)
+			next_poll += self.interval_sec if 0 < len(vars) else IDLE_SEC
+			now = time.time()
+			if next_poll < now:
+				next_poll = now		# fell behind, e.g. while reconnecting
+			time.sleep(next_poll - now)
+
+	def follow(self):
+		while True:
+			with self.feed_lock:
+				vars = self.wanted()
+				data = self.feed.subscribe(vars) if 0 < len(vars) else None
+			if data is None:
+				time.sleep(IDLE_SEC)
+				continue
+			self.fan_out(data)
+			for data in self.feed.updates():
+				self.fan_out(data)
+
+	def subscribe_more(self, vars):
+		# Adds the variables of a new session to the running subscription; the
+		# reply arrives through updates() on the hub thread. Without a connection
+		# follow() subscribes to all of them when it reconnects.
+		with self.feed_lock:
+			sock = self.feed.sock
+			if sock is None:
+				return
+			try:
+				sock.sendall(self.feed.encode('subscribe', vars))
+			except socket.error:
+				pass
+
+
+hub = None
+hub_lock = Lock()
+
+def get_hub(host, port, interval_sec, push=False):
+	# Sessions run bokeh_app.py afresh but share imported modules, so the first
+	# session starts the hub and the rest reuse it
+	global hub
+	with hub_lock:
+		if hub is None:
+			hub = MetricsHub(host, port, interval_sec, push)
+	return hub
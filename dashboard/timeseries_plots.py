@@ -1,17 +1,93 @@
 import numpy as np
-from datetime import datetime
+from collections import deque
+from datetime import datetime, timedelta
 from bokeh.models import ColumnDataSource, HoverTool, Legend, SaveTool
 from bokeh.plotting import figure
 
+DISPLAY_TIME_FORMAT = '%m-%d-%Y %H:%M:%S.%f'
+EPOCH = datetime(1970, 1, 1)
+RAW_SEC = 600				# the newest samples are plotted as they are...
+BUCKET_SEC = 60				# ...older ones as the mean (and min/max) of each bucket
+RETENTION_SEC = 86400		# and dropped after this
+
+
+def seconds(time):
+	return (time - EPOCH).total_seconds()
+
+
+class SeriesBuffer(object):
+	# Samples of one figure's metrics on a shared time axis (NaN where a metric
+	# had no value): the last raw_sec seconds as they arrived, older ones merged
+	# into bucket_sec buckets kept for retention_sec, so the points a session
+	# holds and renders stay bounded however long it is open
+	def __init__(self, metrics, raw_sec=RAW_SEC, bucket_sec=BUCKET_SEC, retention_sec=RETENTION_SEC):
+		self.metrics = metrics
+		self.raw_sec = raw_sec
+		self.bucket_sec = bucket_sec
+		self.retention_sec = retention_sec
+		self.raw = deque()		# (time, display_time, vals)
+		self.buckets = deque()	# (time, display_time, means, mins, maxs)
+
+	def append(self, time, display_time, vals):
+		# vals = [val per metric]; returns whether older points changed, i.e. the
+		# plot needs columns() rather than just row()
+		self.raw.append((time, display_time, np.array(vals, dtype=float)))
+		return self.compact(seconds(time))
+
+	def compact(self, now):
+		changed = False
+		boundary = (now - self.raw_sec) // self.bucket_sec * self.bucket_sec
+		while 0 < len(self.raw) and seconds(self.raw[0][0]) < boundary:
+			start = seconds(self.raw[0][0]) // self.bucket_sec * self.bucket_sec
+			rows = []
+			while 0 < len(self.raw) and seconds(self.raw[0][0]) < start + self.bucket_sec:
+				rows.append(self.raw.popleft()[2])
+			self.buckets.append(self.bucket(start, np.array(rows)))
+			changed = True
+		while 0 < len(self.buckets) and seconds(self.buckets[0][0]) < boundary - self.retention_sec:
+			self.buckets.popleft()
+			changed = True
+		return changed
+
+	def bucket(self, start, rows):
+		valid = ~np.isnan(rows)
+		counts = valid.sum(axis=0)
+		means = np.where(valid, rows, 0.0).sum(axis=0) / np.maximum(counts, 1)
+		mins = np.where(valid, rows, np.inf).min(axis=0)
+		maxs = np.where(valid, rows, -np.inf).max(axis=0)
+		(means, mins, maxs) = [np.where(0 < counts, a, np.nan) for a in (means, mins, maxs)]
+		time = EPOCH + timedelta(seconds=start + self.bucket_sec / 2.0)
+		return (time, time.strftime(DISPLAY_TIME_FORMAT), means, mins, maxs)
+
+	def to_columns(self, points):
+		# points = [(time, display_time, means, mins, maxs)]
+		columns = {'time': [p[0] for p in points], 'display_time': [p[1] for p in points]}
+		for (i, metric) in enumerate(self.metrics):
+			columns[metric] = [p[2][i] for p in points]
+			columns[metric + '_min'] = [p[3][i] for p in points]
+			columns[metric + '_max'] = [p[4][i] for p in points]
+		return columns
+
+	def columns(self):
+		raw = [(time, display_time, vals, vals, vals) for (time, display_time, vals) in self.raw]
+		return self.to_columns(list(self.buckets) + raw)
+
+	def row(self):
+		# The newest point as columns for ColumnDataSource.stream()
+		(time, display_time, vals) = self.raw[-1]
+		return self.to_columns([(time, display_time, vals, vals, vals)])
+
 
 class TimeSeriesPlot(object):
 	tools = 'pan, xbox_zoom, save, reset'
-	hover = HoverTool(tooltips=[("Time", "@display_time"), ("Data", "@data")])
 	x_range = None
 	default_width  = 460
 	default_height = 240
 	default_line_width = 2
 	default_muted_alpha = 0.2
+	raw_sec = RAW_SEC
+	bucket_sec = BUCKET_SEC
+	retention_sec = RETENTION_SEC
 
 	def __init__(self, metrics, queries, requests, line_colors, line_dashes=None):
 		self.metrics = metrics
@@ -19,7 +95,8 @@ class TimeSeriesPlot(object):
 		self.requests = requests
 		self.line_colors = line_colors
 		self.line_dashes = line_dashes
-		self.data_sources = {}
+		self.buffer = SeriesBuffer(metrics, self.raw_sec, self.bucket_sec, self.retention_sec)
+		self.data_source = None		# one column per metric on a shared time axis
 
 	def create_plot(self, title, width=default_width, height=default_height, 
 					xaxis_label='Time', yaxis_label='Data', line_width=default_line_width):
@@ -31,23 +108,25 @@ class TimeSeriesPlot(object):
 			p = figure(plot_width=width, plot_height=height, x_axis_type='datetime', tools=self.tools, 
 					   toolbar_location='above', title=title, x_range=TimeSeriesPlot.x_range)
 
+		self.data_source = ColumnDataSource(self.buffer.columns())
 		legend_items = []
 		for metric in self.metrics:
-			self.data_sources[metric] = ColumnDataSource(dict(time=[], display_time=[], data=[]))
 			if self.line_dashes is not None:
-				r = p.line(source=self.data_sources[metric], x='time', y='data', color=self.line_colors[metric], line_dash=self.line_dashes[metric], line_width=self.default_line_width, muted_color=self.line_colors[metric], muted_alpha=self.default_muted_alpha)
+				r = p.line(source=self.data_source, x='time', y=metric, color=self.line_colors[metric], line_dash=self.line_dashes[metric], line_width=self.default_line_width, muted_color=self.line_colors[metric], muted_alpha=self.default_muted_alpha)
 			else:
-				r = p.line(source=self.data_sources[metric], x='time', y='data', color=self.line_colors[metric], line_width=self.default_line_width, muted_color=self.line_colors[metric], muted_alpha=self.default_muted_alpha)
+				r = p.line(source=self.data_source, x='time', y=metric, color=self.line_colors[metric], line_width=self.default_line_width, muted_color=self.line_colors[metric], muted_alpha=self.default_muted_alpha)
 			if 1 < len(self.metrics):
 				legend_items.append((metric, [r]))
 		legend = Legend(items=legend_items, click_policy='mute', orientation='horizontal', 
 						location='top_center', border_line_color=None)
+		tooltips = [("Time", "@display_time")] + \
+			[(metric, '@{%s} [@{%s_min}, @{%s_max}]' % (metric, metric, metric)) for metric in self.metrics]
 			
 		p.y_range.start = 0
 		p.xaxis.axis_label = xaxis_label
 		p.yaxis.axis_label = yaxis_label
 		p.add_layout(legend, 'below')
-		p.add_tools(self.hover)
+		p.add_tools(HoverTool(tooltips=tooltips))
 
 		self.p = p
 		return p
@@ -68,14 +147,42 @@ class TimeSeriesPlot(object):
 	def get_requests(self):
 		return self.requests
 
-	def update_plot(self, time, display_time, updated_data):
-		data = []
+	def append(self, time, display_time, vals):
+		# vals = {metric: val or None}; streams the new row, or replaces the
+		# columns when older points were merged into buckets or expired
+		if all([vals.get(metric) is None for metric in self.metrics]):
+			return
+		row = [np.nan if vals.get(metric) is None else vals[metric] for metric in self.metrics]
+		if self.buffer.append(time[0], display_time[0], row):
+			self.data_source.data = self.buffer.columns()
+		else:
+			self.data_source.stream(self.buffer.row())
+
+	def stream_history(self, series):
+		# series = {metric: (timestamps, vals)}, merged onto one time axis
+		rows = {}
+		for (metric, (timestamps, vals)) in series.items():
+			for (t, val) in zip(timestamps, vals):
+				rows.setdefault(t, {})[metric] = val
+		for t in sorted(rows):
+			time = datetime.fromtimestamp(t)
+			row = [rows[t].get(metric, np.nan) for metric in self.metrics]
+			self.buffer.append(time, time.strftime(DISPLAY_TIME_FORMAT), row)
+		self.data_source.data = self.buffer.columns()
+
+	def backfill(self, history):
+		# history = {query: {'time': [...], 'data': [...]}} from a range request
+		series = {}
 		for metric in self.metrics:
-			val = self.get_data(updated_data, self.queries[metric])
-			if val is not None:
-				self.data_sources[metric].stream(dict(time=time, display_time=display_time, data=[val]))
-			data.append(val)
-		return data
+			s = history.get(self.queries[metric])
+			if s is not None:
+				series[metric] = (s['time'], s['data'])
+		self.stream_history(series)
+
+	def update_plot(self, time, display_time, updated_data):
+		vals = dict((metric, self.get_data(updated_data, self.queries[metric])) for metric in self.metrics)
+		self.append(time, display_time, vals)
+		return [vals[metric] for metric in self.metrics]
 
 
 class MsgsPlot(TimeSeriesPlot):
@@ -115,24 +222,35 @@ class BytesPlot(TimeSeriesPlot):
 												  yaxis_label='Data Rate [Kbytes/sec]')
 
 	def update_plot(self, time, display_time, updated_data):
-		data = []
+		vals = {}
 		for metric in self.metrics:
 			val = self.get_data(updated_data, self.queries[metric])
-			if val is not None:
-				val = float(val) / 1024 # bytes/s -> Kbytes/s
-				self.data_sources[metric].stream(dict(time=time, display_time=display_time, data=[val]))
-			data.append(val)
-		return data
+			vals[metric] = float(val) / 1024 if val is not None else None # bytes/s -> Kbytes/s
+		self.append(time, display_time, vals)
+		return [vals[metric] for metric in self.metrics]
+
+	def backfill(self, history):
+		series = {}
+		for metric in self.metrics:
+			s = history.get(self.queries[metric])
+			if s is not None:
+				series[metric] = (s['time'], [float(val) / 1024 for val in s['data']]) # bytes/s -> Kbytes/s
+		self.stream_history(series)
 
 
 class LagsPlot(TimeSeriesPlot):
-	metrics = ['max', 'min', 'mean']
-	queries = {'max': 'lags#max', 'min': 'lags#min', 'mean': 'lags#mean'}
+	metrics = ['max', 'p99', 'p95', 'p50', 'mean', 'min']
+	queries = {'max': 'lags#max', 'p99': 'lags#p99', 'p95': 'lags#p95', 'p50': 'lags#p50',
+			   'mean': 'lags#mean', 'min': 'lags#min'}
 	requests = ['lags']
-	line_colors = {'max': 'plum', 'min': 'palegoldenrod', 'mean': 'lightcoral'}
+	line_colors = {'max': 'plum', 'p99': 'orchid', 'p95': 'mediumorchid', 'p50': 'salmon',
+				   'mean': 'lightcoral', 'min': 'palegoldenrod'}
+	line_dashes = {'max': 'solid', 'p99': 'dashed', 'p95': 'dashed', 'p50': 'dashed',
+				   'mean': 'solid', 'min': 'solid'}
 
 	def __init__(self):
-		super(LagsPlot, self).__init__(self.metrics, self.queries, self.requests, self.line_colors)
+		super(LagsPlot, self).__init__(self.metrics, self.queries, self.requests,
+									   self.line_colors, self.line_dashes)
 
 	def create_plot(self):
 		return super(LagsPlot, self).create_plot('Offset Lags',
@@ -154,8 +272,8 @@ class VmPlot(TimeSeriesPlot):
 
 class MsgsizePlot(TimeSeriesPlot):
 	metrics = ['msgsize']
-	queries = {'bytesin': 'jmx#bytesin_1min', 'msgsin': 'jmx#msgsin_1min'}
-	requests = ['jmx']
+	queries = {'msgsize': 'msgsize'}		# jmx bytesin/msgsin, derived by the server
+	requests = ['msgsize']
 	line_colors = {'msgsize': 'skyblue'}
 
 	def __init__(self):
@@ -164,16 +282,6 @@ class MsgsizePlot(TimeSeriesPlot):
 	def create_plot(self):
 		return super(MsgsizePlot, self).create_plot('Message Size', yaxis_label='Message Size [bytes]')
 
-	def update_plot(self, time, display_time, updated_data):
-		bytesin = super(MsgsizePlot, self).get_data(updated_data, self.queries['bytesin'])
-		msgsin = super(MsgsizePlot, self).get_data(updated_data, self.queries['msgsin'])
-
-		metric = self.metrics[0]
-		val = None
-		if 0.0 < msgsin:
-			val = bytesin / msgsin
-			self.data_sources[metric].stream(dict(time=time, display_time=display_time, data=[val]))
-		return [val]
 
 class WaitTimePlot(TimeSeriesPlot):
 	metrics = ['wait_time']
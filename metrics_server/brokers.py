@@ -0,0 +1,95 @@
+from threading import Lock
+from sampling import HOST_SEPARATOR
+from timeseries import flatten, FIELD_SEPARATOR
+
+# Constants
+BROKER_TIMEOUT_SEC = 60.0		# brokers silent for longer drop out of the totals
+EXPIRE_INTERVAL_SEC = 10.0		# between passes dropping them
+
+
+def split_host(var):
+	# 'jmx@kafka1' -> ('jmx', 'kafka1'), 'jmx' -> ('jmx', None)
+	(base, sep, host) = var.partition(HOST_SEPARATOR)
+	return (base, host) if sep else (var, None)
+
+def unflatten(base, leaves):
+	# {'jmx#bytesin_1min': 1.0, ...} -> {'bytesin_1min': 1.0, ...}; {'bytesin': 1.0} -> 1.0
+	if base in leaves:
+		return leaves[base]
+	val = {}
+	for (name, leaf) in leaves.items():
+		keys = name.split(FIELD_SEPARATOR)[1:]
+		d = val
+		for key in keys[:-1]:
+			d = d.setdefault(key, {})
+		d[keys[-1]] = leaf
+	return val
+
+
+class ClusterTotals(object):
+	# Cluster-wide view of host-tagged samples: every numeric leaf of a
+	# variable is summed over the brokers reporting it, updated by the change
+	# of one broker's value rather than re-adding all of them, and the skew
+	# (max over mean across brokers) tells whether one broker carries more
+	# than its share. Silent brokers are dropped, and the running sums
+	# recomputed exactly so float rounding cannot accumulate, in a separate
+	# pass every expire_interval_sec.
+	def __init__(self, timeout_sec=BROKER_TIMEOUT_SEC, expire_interval_sec=EXPIRE_INTERVAL_SEC):
+		self.timeout_sec = timeout_sec
+		self.expire_interval_sec = expire_interval_sec
+		self.last_expiry = None
+		self.latest = {}	# base -> {host: (time, {leaf: val})}
+		self.totals = {}	# base -> {leaf: sum over hosts}
+		self.counts = {}	# base -> {leaf: number of hosts reporting it}
+		self.skews = {}		# base -> {leaf: max over mean across hosts}
+		self.lock = Lock()
+
+	def update(self, var, val, now):
+		# Returns [(base, totals), (base_skew, skews)] for a host-tagged var
+		# received at now, or [] for any other var
+		(base, host) = split_host(var)
+		if host is None:
+			return []
+		leaves = dict(flatten(base, val))
+		with self.lock:
+			if self.last_expiry is None or self.expire_interval_sec <= now - self.last_expiry:
+				self.expire(now)
+			brokers = self.latest.setdefault(base, {})
+			old = brokers.get(host, (now, {}))[1]
+			brokers[host] = (now, leaves)
+			self.replace(base, old, leaves)
+			return [(base, unflatten(base, self.totals[base])),
+					(base + '_skew', unflatten(base, self.skews[base]))]
+
+	def expire(self, now):
+		# Drops brokers silent for timeout_sec and resums every leaf exactly
+		self.last_expiry = now
+		for (base, brokers) in self.latest.items():
+			for (host, (time, leaves)) in brokers.items():
+				if self.timeout_sec < now - time:
+					del brokers[host]
+					self.replace(base, leaves, {})
+			totals = self.totals.get(base, {})
+			for name in totals:
+				totals[name] = sum([b[1][name] for b in brokers.values() if name in b[1]])
+
+	def replace(self, base, old, new):
+		# Swaps one broker's leaves old for new (already in latest) in the
+		# totals and skews of base
+		brokers = self.latest[base]
+		totals = self.totals.setdefault(base, {})
+		counts = self.counts.setdefault(base, {})
+		skews = self.skews.setdefault(base, {})
+		for name in set(old) | set(new):
+			totals[name] = totals.get(name, 0) + new.get(name, 0) - old.get(name, 0)
+			counts[name] = counts.get(name, 0) + (name in new) - (name in old)
+			if counts[name] == 0:
+				del totals[name]
+				del counts[name]
+				del skews[name]
+				continue
+			vals = [b[1][name] for b in brokers.values() if name in b[1]]
+			if counts[name] == 1:
+				totals[name] = vals[0]	# exact again, without the drift of + new - old
+			mean = float(totals[name]) / len(vals)
+			skews[name] = max(vals) / mean if 0 < mean else 0.0
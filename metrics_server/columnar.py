@@ -0,0 +1,163 @@
+import argparse
+import json
+import os
+import struct
+import sys
+import time
+import urllib
+import numpy as np
+from Queue import Queue, Empty, Full
+from threading import Thread
+from timeseries import flatten, downsample, FIELD_SEPARATOR
+
+# Constants
+DATA_DIR = './data'
+MAX_SERIES = 1024			# column files written at most
+QUEUE_SIZE = 65536			# samples waiting for the writer
+FLUSH_INTERVAL_SEC = 1.0
+COLUMN_SUFFIX = '.col'
+RECORD = np.dtype([('time', '<f8'), ('data', '<f8')])	# fixed-width, little-endian
+RECORD_FORMAT = '<dd'
+
+
+def column_path(data_dir, name):
+	return os.path.join(data_dir, urllib.quote(name, safe='') + COLUMN_SUFFIX)
+
+def column_names(data_dir):
+	if not os.path.isdir(data_dir):
+		return []
+	return [urllib.unquote(f[:-len(COLUMN_SUFFIX)]) for f in os.listdir(data_dir)
+			if f.endswith(COLUMN_SUFFIX)]
+
+def last_time(path):
+	# Time of the last whole record in a column file
+	with open(path, 'rb') as f:
+		f.seek((os.path.getsize(path) // RECORD.itemsize - 1) * RECORD.itemsize)
+		return struct.unpack(RECORD_FORMAT, f.read(RECORD.itemsize))[0]
+
+
+class ColumnWriter(Thread):
+	# Appends every numeric leaf of every variable, e.g. 'lags#max', as
+	# (timestamp, value) records to its own column file from a background
+	# thread; record() only enqueues, so ingest never waits for disk. Files
+	# left in data_dir by earlier runs count against max_series
+	def __init__(self, data_dir=DATA_DIR, max_series=MAX_SERIES):
+		Thread.__init__(self, name='ColumnWriter')
+		self.daemon = True
+		self.data_dir = data_dir
+		self.max_series = max_series
+		self.queue = Queue(QUEUE_SIZE)
+		self.files = {}
+		self.series = set(column_names(data_dir))	# names with a column file
+		self.last_times = {}	# name -> time of its last record, which stay sorted
+		self.dropped = 0
+		if not os.path.isdir(data_dir):
+			os.makedirs(data_dir)
+
+	def record(self, var, val, time):
+		for (name, leaf) in flatten(var, val):
+			try:
+				self.queue.put_nowait((name, time, leaf))
+			except Full:
+				self.dropped += 1
+
+	def close(self):
+		self.queue.put(None)
+		self.join()
+
+	def run(self):
+		last_flush = time.time()
+		while True:
+			try:
+				sample = self.queue.get(timeout=FLUSH_INTERVAL_SEC)
+			except Empty:
+				sample = ()
+			if sample is None:
+				break
+			if 0 < len(sample):
+				self.append(*sample)
+			now = time.time()
+			if FLUSH_INTERVAL_SEC <= now - last_flush:
+				for f in self.files.values():
+					f.flush()
+				last_flush = now
+		for f in self.files.values():
+			f.close()
+
+	def append(self, name, time, val):
+		f = self.files.get(name)
+		if f is None:
+			if name not in self.series and self.max_series <= len(self.series):
+				return
+			f = self.files[name] = open(column_path(self.data_dir, name), 'ab')
+			self.series.add(name)
+			if RECORD.itemsize <= f.tell():
+				self.last_times[name] = last_time(column_path(self.data_dir, name))
+		if time < self.last_times.get(name, time):
+			return		# computed by another thread after a newer sample
+		self.last_times[name] = time
+		f.write(struct.pack(RECORD_FORMAT, time, val))
+
+
+class ColumnReader(object):
+	# Range scans over memory-mapped column files: the timestamps are binary
+	# searched in place and only the selected range is copied out
+	def __init__(self, data_dir=DATA_DIR):
+		self.data_dir = data_dir
+
+	def column(self, name):
+		path = column_path(self.data_dir, name)
+		count = os.path.getsize(path) // RECORD.itemsize	# ignore a partly written record
+		if count == 0:
+			return np.zeros(0, dtype=RECORD)
+		return np.memmap(path, dtype=RECORD, mode='r', shape=(count,))
+
+	def names(self, vars):
+		# Expands top-level variables to all of their series
+		names = column_names(self.data_dir)
+		return sorted(set([name for name in names for var in vars
+					   if name == var or name.startswith(var + FIELD_SEPARATOR)]))
+
+	def range(self, vars, since=0.0, until=float('inf'), step=0.0):
+		# Returns {series: {'time': array, 'data': array}}, averaged into
+		# step-second buckets if step is positive
+		result = {}
+		for name in self.names(vars):
+			column = self.column(name)
+			times = column['time']
+			(start, end) = (np.searchsorted(times, since), np.searchsorted(times, until, 'right'))
+			(times, vals) = (np.array(times[start:end]), np.array(column['data'][start:end]))
+			if 0.0 < step and 0 < len(times):
+				(times, vals) = downsample(times, vals, step)
+			result[name] = {'time': times, 'data': vals}
+		return result
+
+
+if __name__ == "__main__":
+	# Exports persisted series for post-mortems, e.g.
+	#   python columnar.py -v msgsin lags --since 1500000000 --step 60 > run.csv
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-d', '--data_dir', default=DATA_DIR, type=str)
+	parser.add_argument('-v', '--vars', nargs='*', type=str,
+						help='variables or series to export (default: all)')
+	parser.add_argument('--since', default=0.0, type=float, help='epoch seconds')
+	parser.add_argument('--until', default=float('inf'), type=float, help='epoch seconds')
+	parser.add_argument('--step', default=0.0, type=float, help='average into buckets of this many seconds')
+	parser.add_argument('-f', '--format', default='csv', choices=['csv', 'json'])
+	args = parser.parse_args()
+
+	reader = ColumnReader(args.data_dir)
+	start = time.time()
+	vars = args.vars if args.vars else column_names(args.data_dir)
+	series = reader.range(vars, args.since, args.until, args.step)
+	sys.stderr.write('Read {} samples of {} series in {:.3f} seconds\n'.format(
+		sum([len(s['time']) for s in series.values()]), len(series), time.time() - start))
+
+	if args.format == 'json':
+		print(json.dumps(dict((name, {'time': s['time'].tolist(), 'data': s['data'].tolist()})
+							  for (name, s) in series.items())))
+	else:
+		print('series,time,data')
+		for name in sorted(series):
+			for (t, v) in zip(series[name]['time'], series[name]['data']):
+				print('{},{:.6f},{!r}'.format(name, t, v))
@@ -1,60 +1,160 @@
+import bisect
+import math
 import numpy as np
 import sys
-from datetime import datetime
+import time
+from collections import deque
+from threading import Lock
+from sampling import clock
 
 
-class OneMinuteRate(object):
-	def __init__(self):
-		self.history = []	
-
-	def add_history(self, time, val):
-		self.history.append((time, val))
+RATE_WINDOW_SEC = 60.0
+MIN_RATE_INTERVAL_SEC = 0.1		# closer samples are folded into the next rate
+EWMA_WINDOWS_SEC = [60.0, 300.0, 900.0]
+LAG_PERCENTILES = [50, 95, 99]
+HOTTEST_PARTITIONS = 3
+MAX_PIPELINES = 1024			# namespaced sources derived at most
 
-	def compute_one_minute_rate(self):
-		# Compute one-minute rate
-		now = datetime.now()
-		self.history[:] = [(time, val) for (time, val) in self.history 
-						   if (now - time).total_seconds() <= 60.0]
-		# print('### history={}'.format(self.history))
-		total = sum([val for (time, val) in self.history])
-		# print('### total={}'.format(total))
-		return (float)(total) / 60.0
 
+class SlidingWindow(object):
+	# Running sum of the values added during the last window_sec seconds
+	def __init__(self, window_sec):
+		self.window_sec = window_sec
+		self.history = deque()
+		self.total = 0
 
-class PartitionsDerivedValue(OneMinuteRate):
+	def add(self, time, val):
+		self.history.append((time, val))
+		self.total += val
+		self.expire(time)
+
+	def expire(self, now):
+		while 0 < len(self.history) and self.window_sec < now - self.history[0][0]:
+			self.total -= self.history.popleft()[1]
+		if len(self.history) == 0:
+			self.total = 0		# do not carry float rounding errors forward
+
+	def rate(self, now):
+		self.expire(now)
+		return float(self.total) / self.window_sec
+
+
+class Ewma(object):
+	# Exponentially weighted moving average of a per-second rate, like the
+	# 1/5/15 minute rates of Kafka's meters, decayed by the actual time elapsed
+	# between samples instead of a fixed tick
+	def __init__(self, window_sec):
+		self.window_sec = window_sec
+		self.rate = None
+
+	def update(self, count, elapsed_sec):
+		instant_rate = float(count) / elapsed_sec
+		if self.rate is None:
+			self.rate = instant_rate
+		else:
+			alpha = 1.0 - math.exp(-elapsed_sec / self.window_sec)
+			self.rate += alpha * (instant_rate - self.rate)
+		return self.rate
+
+
+class RateMeter(object):
+	# Shared engine for derived rates: every mark() updates a sliding-window
+	# rate and a set of EWMAs in O(1) time
+	def __init__(self, window_sec=RATE_WINDOW_SEC, ewma_windows_sec=EWMA_WINDOWS_SEC):
+		self.window = SlidingWindow(window_sec)
+		self.ewmas = [Ewma(w) for w in ewma_windows_sec]
+
+	def mark(self, time, count, elapsed_sec):
+		self.window.add(time, count)
+		for ewma in self.ewmas:
+			ewma.update(count, elapsed_sec)
+
+	def window_rate(self, now):
+		return self.window.rate(now)
+
+	def ewma_rates(self):
+		return [(ewma.window_sec, ewma.rate if ewma.rate is not None else 0.0) for ewma in self.ewmas]
+
+
+class Partitions(object):
+	# One offsets sample as arrays, built in a single pass over the payload and
+	# shared by every derived value of the pipeline instead of each one
+	# walking the dict again
+	def __init__(self, payload):
+		# payload = {"partition_0": {"latest": 1435, "committed": 1387, "timestamp": ...}, ...}
+		payload = payload if payload is not None else {}
+		columns = getattr(payload, 'columns', {})
+		if 'latest' in columns and 'committed' in columns:
+			# a table of the binary protocol holds the arrays already
+			self.names = payload.rows
+			(self.latest, self.committed) = [columns[c].astype(np.float64) for c in ['latest', 'committed']]
+			self.timestamp = columns['timestamp'].astype(np.float64) if 'timestamp' in columns else \
+				np.full(len(self.names), np.nan)
+		else:
+			self.names = list(payload)
+			rows = np.array([(payload[p]['latest'], payload[p]['committed'], payload[p].get('timestamp', np.nan))
+							 for p in self.names], dtype=np.float64).reshape(-1, 3)
+			(self.latest, self.committed, self.timestamp) = rows.T
+		self.lag = self.latest - self.committed
+
+	def __len__(self):
+		return len(self.names)
+
+def as_partitions(partitions):
+	return partitions if isinstance(partitions, Partitions) else Partitions(partitions)
+
+
+def ewma_key(var, window_sec):
+	return '{}_{}min_ewma'.format(var, int(window_sec / 60))
+
+
+class PartitionsDerivedValue(object):
 	def __init__(self, var, partition_field):
-		super(PartitionsDerivedValue, self).__init__()
 		self.partition_field = partition_field
 		self.var = var
+		self.meter = RateMeter()
 		self.last_time = None
 		self.last_val = None
-
-	def compute(self, partitions):
-		# partitions = {"partition_0": {"tail": 1435, "lag": 48, "commited": 1387}, 
-		#               "partition_1": {"tail": 1429, "lag": 0, "commited": 1429}, ...}
-		empty_result = (self.var, {self.var: 0.0, self.var + '_1min': 0.0})
-
-		if partitions is None or partitions == {}:
-			return empty_result
-
-		val = sum([partitions[p][self.partition_field] for p in partitions])
-		now = datetime.now()
-		if self.last_val is None or self.last_time is None or now <= self.last_time:
+		self.last_result = None
+
+	def empty_result(self):
+		vals = {self.var: 0.0, self.var + '_1min': 0.0}
+		for (window_sec, rate) in self.meter.ewma_rates():
+			vals[ewma_key(self.var, window_sec)] = 0.0
+		return (self.var, vals)
+
+	def compute(self, partitions, now=None):
+		# partitions = Partitions or its payload, now = time of the sample on
+		# the monotonic clock
+		partitions = as_partitions(partitions)
+		if len(partitions) == 0:
+			return self.empty_result()
+
+		val = getattr(partitions, self.partition_field).sum()
+		now = now if now is not None else clock()
+		if self.last_val is None or self.last_time is None or now < self.last_time:
+			# first sample, or one stamped before the previous: start over from it
 			self.last_val = val
 			self.last_time = now
-			return empty_result
+			return self.last_result or self.empty_result()
+		if now - self.last_time < MIN_RATE_INTERVAL_SEC:
+			# too close to the previous sample for a meaningful rate; the next
+			# one measures from that sample instead
+			return self.last_result or self.empty_result()
 
 		# Compute per-second change per time
 		delta_val = val - self.last_val
-		rate = delta_val / (now - self.last_time).total_seconds()
-		# print("#### last_val={}, val={}, delta_val={}, delta_sec={}".
-		# 	  format(self.last_val, val, delta_val, (now - self.last_time).total_seconds()))
+		delta_sec = now - self.last_time
+		rate = delta_val / delta_sec
 		self.last_val = val
 		self.last_time = now
-		self.add_history(now, delta_val)
-		min_rate = self.compute_one_minute_rate()
+		self.meter.mark(now, delta_val, delta_sec)
 
-		return (self.var, {self.var: rate, self.var + '_1min': min_rate})
+		vals = {self.var: rate, self.var + '_1min': self.meter.window_rate(now)}
+		for (window_sec, ewma_rate) in self.meter.ewma_rates():
+			vals[ewma_key(self.var, window_sec)] = ewma_rate
+		self.last_result = (self.var, vals)
+		return self.last_result
 
 
 class MsgsIn(PartitionsDerivedValue):
@@ -68,104 +168,225 @@ class MsgsOut(PartitionsDerivedValue):
 
 
 class OffsetLags(object):
-	def compute(self, partitions):
-		if partitions is None or partitions == {}:
-			return ('lags', {'min': 0.0, 'max': 0.0, 'mean': 0.0, 'num': 0})
+	# Lag statistics over the partitions of a sample; one argsort of the lags
+	# yields the extremes, percentiles and hottest partitions
+	def empty_result(self):
+		stats = {'min': 0.0, 'max': 0.0, 'mean': 0.0, 'num': 0, 'sum': 0.0, 'latest': 0.0,
+				 'committed': 0.0, 'skew': 0.0, 'hottest': []}
+		for q in LAG_PERCENTILES:
+			stats['p{}'.format(q)] = 0.0
+		return ('lags', stats)
 
-		lags = [partitions[p]['lag'] for p in partitions]
-		stats = {'max': max(lags), 'min': min(lags), 'mean': np.mean(lags), 'num': len(partitions)}
+	def compute(self, partitions, now=None):
+		partitions = as_partitions(partitions)
+		if len(partitions) == 0:
+			return self.empty_result()
+
+		order = np.argsort(partitions.lag, kind='mergesort')
+		lags = partitions.lag[order]
+		mean = lags.mean()
+		stats = {'max': float(lags[-1]), 'min': float(lags[0]), 'mean': float(mean),
+				 'num': len(partitions), 'sum': float(lags.sum()),
+				 'latest': float(partitions.latest.sum()), 'committed': float(partitions.committed.sum()),
+				 # how far the most lagging partition is ahead of the average one
+				 'skew': float(lags[-1] / mean) if 0 < mean else 0.0,
+				 'hottest': [partitions.names[i] for i in order[::-1][:HOTTEST_PARTITIONS]]}
+		for (q, val) in zip(LAG_PERCENTILES, np.percentile(lags, LAG_PERCENTILES)):
+			stats['p{}'.format(q)] = float(val)
 
 		return ('lags', stats)
 
 
+class OffsetTimeline(object):
+	# Piecewise-linear map from offset to the time it was reached, kept as
+	# breakpoints (strictly increasing offsets) instead of one entry per offset
+	def __init__(self):
+		self.offsets = []
+		self.times = []
+
+	def append(self, offset, time):
+		# Returns whether the timeline holds at least two samples to compare,
+		# counting offsets that samples were merged into
+		appended = offset is not None and time is not None
+		ready = 1 < self.span() or (0 < len(self.offsets) and appended)
+		if not appended:
+			return ready
+		if len(self.offsets) == 0 or self.offsets[-1] < offset:
+			self.offsets.append(offset)
+			self.times.append(time)
+		elif self.offsets[-1] == offset:
+			# no new messages: only the last offset is stamped with the newest
+			# time, so pin the one before it to where it was interpolated
+			if 1 < len(self.offsets) and self.offsets[-2] < offset - 1:
+				pinned_time = np.interp(offset - 1, self.offsets[-2:], self.times[-2:])
+				self.offsets.insert(-1, offset - 1)
+				self.times.insert(-1, pinned_time)
+			self.times[-1] = time
+		else:
+			# offsets went backwards (e.g. reset), start over
+			self.offsets = [offset]
+			self.times = [time]
+			return False
+		return ready
+
+	def span(self):
+		return self.offsets[-1] - self.offsets[0] + 1 if 0 < len(self.offsets) else 0
+
+	def segments(self):
+		# Returns (starts, ends, times, slopes) such that every integer offset
+		# belongs to exactly one closed segment [start, end]
+		offsets = np.array(self.offsets, dtype=np.float64)
+		times = np.array(self.times, dtype=np.float64)
+		if len(offsets) == 1:
+			return (offsets, offsets, times, np.zeros(1))
+		slopes = np.diff(times) / np.diff(offsets)
+		ends = offsets[1:] - 1
+		ends[-1] += 1
+		return (offsets[:-1], ends, times[:-1], slopes)
+
+	def discard_before(self, offset):
+		# Drops everything before offset, keeping an interpolated breakpoint at it
+		time = np.interp(offset, self.offsets, self.times)
+		i = bisect.bisect_right(self.offsets, offset)
+		self.offsets = [offset] + self.offsets[i:]
+		self.times = [time] + self.times[i:]
+
+
 class WaitTime(object):
-	_latest = {}
-	_committed = {}
-
-	def compute(self, partitions):
-		delta_timestamps = np.array([])
-
-		latest = self._latest
-		committed = self._committed
-
-		for p in partitions:
-			latest_offset = partitions[p]['latest']
-			committed_offset = partitions[p]['committed']
-			timestamp = partitions[p]['timestamp']
-
-			# init latest & committed
-			if not latest.has_key(p):
-				latest[p] = {'offset': np.array([]), 'timestamp': np.array([])}
-			if not committed.has_key(p):
-				committed[p] = {'offset': np.array([]), 'timestamp': np.array([])}
-
-			if (latest_offset is not None) and (timestamp is not None):
-				latest[p]['offset'] = np.append(latest[p]['offset'], latest_offset)
-				latest[p]['timestamp'] = np.append(latest[p]['timestamp'], timestamp)
-			if (committed_offset is not None) and (timestamp is not None):
-				committed[p]['offset'] = np.append(committed[p]['offset'], committed_offset)
-				committed[p]['timestamp'] = np.append(committed[p]['timestamp'], timestamp)
-
-			if len(latest[p]['offset']) <= 1 or len(committed[p]['offset']) <= 1:
+	# Mean time between an offset becoming the latest and being committed,
+	# over the offsets committed since the previous sample. Both offsets grow
+	# linearly between samples, so the per-offset sums are arithmetic series
+	# computed from the segment endpoints only.
+	def __init__(self):
+		self._latest = {}
+		self._committed = {}
+
+	def compute(self, partitions, now=None):
+		partitions = as_partitions(partitions)
+		los = []
+		his = []
+		segments = []
+		signs = []
+		count = 0
+
+		for (i, p) in enumerate(partitions.names):
+			latest = self._latest.setdefault(p, OffsetTimeline())
+			committed = self._committed.setdefault(p, OffsetTimeline())
+			timestamp = partitions.timestamp[i]
+			latest_ready = latest.append(partitions.latest[i], timestamp)
+			committed_ready = committed.append(partitions.committed[i], timestamp)
+			if not (latest_ready and committed_ready):
 				continue
 
-			# there are at least more than 1 elements both in latest and committed
-			latest_offset_range = np.arange(latest[p]['offset'][-2], latest[p]['offset'][-1] + 1)
-			# print('latest[p][offset][-1]={}, latest[p][offset][-2]={}'.format(latest[p]['offset'][-1], latest[p]['offset'][-2]))
-			latest_interp = np.interp(latest_offset_range,
-									  [latest[p]['offset'][-2], latest[p]['offset'][-1]],
-									  [latest[p]['timestamp'][-2], latest[p]['timestamp'][-1]])
-			latest[p]['offset'] = np.append(latest[p]['offset'][:-2], latest_offset_range)
-			latest[p]['timestamp'] = np.append(latest[p]['timestamp'][:-2], latest_interp)
-
-			committed_offset_range = np.arange(committed[p]['offset'][-2], committed_offset + 1)
-			committed_interp = np.interp(committed_offset_range,
-										 [committed[p]['offset'][-2], committed_offset],
-										 [committed[p]['timestamp'][-2], timestamp])
-			committed[p]['offset'] = np.append(committed[p]['offset'][:-2], committed_offset_range)
-			committed[p]['timestamp'] = np.append(committed[p]['timestamp'][:-2], committed_interp)
-
-			# find common offsets from committed and latest
-			min_committed = committed[p]['offset'][0]
-			max_committed = committed[p]['offset'][-1]
-			common_offsets = latest[p]['offset'][(min_committed <= latest[p]['offset']) & (latest[p]['offset'] <= max_committed)]
-			# print('### Before uptates')
-			# print('### latest[p][offset]={}'.format(latest[p]['offset']))
-			# print('### committed[p][offset]={}'.format(committed[p]['offset']))
-			# print('### common_offsets={}'.format(common_offsets))
-
-			latest_timestamps = latest[p]['timestamp'][(common_offsets[0] <= latest[p]['offset']) & (latest[p]['offset'] <= common_offsets[-1])]
-			committed_timestamps = committed[p]['timestamp'][(common_offsets[0] <= committed[p]['offset']) & (committed[p]['offset'] <= common_offsets[-1])]
-			delta = [(committed_timestamps[i] - latest_timestamps[i]) for i in range(0, len(committed_timestamps))]
-			delta_timestamps = np.append(delta_timestamps, delta)
-			# print('### delta_timestamps={}'.format(delta_timestamps))
-			
-			# remove processed offsets info
-			filter = common_offsets[-1] <= latest[p]['offset']
-			latest[p]['offset'] = latest[p]['offset'][filter]
-			latest[p]['timestamp'] = latest[p]['timestamp'][filter]
-			filter = common_offsets[-1] <= committed[p]['offset']
-			committed[p]['offset'] = committed[p]['offset'][filter]
-			committed[p]['timestamp'] = committed[p]['timestamp'][filter]
-
-			# print('### After updates')
-			# print('### latest[p][offset]={}'.format(latest[p]['offset']))
-			# print('### committed[p][offset]={}'.format(committed[p]['offset']))
-
-		return ('wait_time', np.mean(delta_timestamps) if 0 < len(delta_timestamps) else None)
-
-			
-
-				
-						   
-
-				
-				
-				
-				
-											
-			
-		
-		
-	
-	
+			# offsets both reached as latest and committed
+			lo = max(latest.offsets[0], committed.offsets[0])
+			hi = min(latest.offsets[-1], committed.offsets[-1])
+			if hi < lo:
+				continue
+			count += hi - lo + 1
+
+			for (timeline, sign) in [(committed, 1.0), (latest, -1.0)]:
+				seg = timeline.segments()
+				segments.append(seg)
+				los.append(np.full(len(seg[0]), lo, dtype=np.float64))
+				his.append(np.full(len(seg[0]), hi, dtype=np.float64))
+				signs.append(np.full(len(seg[0]), sign))
+			latest.discard_before(hi)
+			committed.discard_before(hi)
+
+		if len(segments) == 0:
+			return ('wait_time', None)
+
+		# sum over integer offsets o in [x, y] of time + (o - start) * slope
+		(starts, ends, times, slopes) = [np.concatenate(field) for field in zip(*segments)]
+		times = times - times.min()		# keep the sums small to avoid cancellation
+		lo = np.concatenate(los)
+		hi = np.concatenate(his)
+		x = np.maximum(lo, starts)
+		y = np.minimum(hi, ends)
+		n = np.maximum(y - x + 1, 0)
+		sums = n * (times + slopes * ((x + y) / 2.0 - starts))
+		total = np.dot(np.concatenate(signs), sums)
+
+		return ('wait_time', total / count)
+
+
+# Derived values computed from each source variable, and the structure its
+# samples are converted to once before they are
+DERIVED_VALUES = {'offsets': [MsgsIn, MsgsOut, OffsetLags, WaitTime]}
+SOURCE_FORMATS = {'offsets': Partitions}
+NAMESPACE_SEPARATOR = '/'	# e.g. 'offsets/<topic>/<group>' -> 'msgsin/<topic>/<group>'
+
+
+def split_namespace(var):
+	# 'offsets/<topic>/<group>' -> ('offsets', '/<topic>/<group>')
+	i = var.find(NAMESPACE_SEPARATOR)
+	return (var, '') if i < 0 else (var[:i], var[i:])
+
+
+class Pipeline(object):
+	# Derived values of one source variable with their own state, so samples
+	# of different topics or consumer groups never mix
+	def __init__(self, namespace, classes, source_format=None, stats=None):
+		self.namespace = namespace
+		self.derived_values = [cls() for cls in classes]
+		self.source_format = source_format
+		self.stats = stats		# times every derived value class if given
+		self.lock = Lock()
+
+	def parse(self, val):
+		# Converts a sample to the source format once; raises on a malformed one
+		if self.source_format is None or isinstance(val, self.source_format):
+			return val
+		start = time.time()
+		val = self.source_format(val)
+		self.timed(self.source_format.__name__, start)
+		return val
+
+	def compute(self, val, now=None):
+		# Returns [(namespaced var, val), ...] for a sample, parsed or not
+		results = []
+		val = self.parse(val)
+		with self.lock:
+			for derived_value in self.derived_values:
+				start = time.time()
+				(new_var, new_val) = derived_value.compute(val, now)
+				self.timed(type(derived_value).__name__, start)
+				results.append((new_var + self.namespace, new_val))
+		return results
+
+	def timed(self, name, start):
+		if self.stats is not None:
+			self.stats.time_derived(name, time.time() - start)
+
+
+class Pipelines(object):
+	# One Pipeline per namespaced source variable, created on its first sample;
+	# pipelines are independent, so different sources compute in parallel.
+	# Sources beyond max_pipelines are rejected, so clients inventing
+	# namespaces cannot grow the server without bound
+	def __init__(self, derived_values=DERIVED_VALUES, source_formats=SOURCE_FORMATS, stats=None,
+				 max_pipelines=MAX_PIPELINES):
+		self.derived_values = derived_values
+		self.source_formats = source_formats
+		self.stats = stats
+		self.max_pipelines = max_pipelines
+		self.pipelines = {}
+		self.lock = Lock()
+
+	def derives(self, var):
+		return split_namespace(var)[0] in self.derived_values
+
+	def get(self, var):
+		pipeline = self.pipelines.get(var)
+		if pipeline is None:
+			with self.lock:
+				if var not in self.pipelines:
+					if self.max_pipelines <= len(self.pipelines):
+						raise ValueError('Too many derived sources ({}), rejected {}'.format(
+							len(self.pipelines), var))
+					(source, namespace) = split_namespace(var)
+					self.pipelines[var] = Pipeline(namespace, self.derived_values[source],
+												   self.source_formats.get(source), self.stats)
+				pipeline = self.pipelines[var]
+		return pipeline
@@ -0,0 +1,89 @@
+from wire import FRAME_HEADER
+
+# Constants
+MAX_LINE_BYTES = 16777216		# longest request accepted without a newline (or frame)
+
+
+class LineTooLong(Exception):
+	pass
+
+
+class LineBuffer(object):
+	# Reassembles newline-terminated requests from arbitrary recv() chunks:
+	# a chunk may hold several requests, or only part of one. Chunks of an
+	# unfinished request are joined once its newline arrives, rather than
+	# copying everything received so far on every chunk.
+	def __init__(self, max_line_bytes=MAX_LINE_BYTES):
+		self.max_line_bytes = max_line_bytes
+		self.chunks = []		# received since the last newline
+		self.size = 0
+
+	def feed(self, data):
+		# Returns every request completed by data, without line terminators
+		if '\n' not in data:
+			self.chunks.append(data)
+			self.size += len(data)
+			self.check_length()
+			return []
+		lines = ''.join(self.chunks + [data]).split('\n')
+		tail = lines.pop()
+		(self.chunks, self.size) = ([tail], len(tail))
+		self.check_length()
+		return [line for line in map(strip_line, lines) if 0 < len(line)]
+
+	def flush(self):
+		# Returns the unterminated tail left when the peer closes the connection
+		line = strip_line(''.join(self.chunks))
+		(self.chunks, self.size) = ([], 0)
+		return [line] if 0 < len(line) else []
+
+	def check_length(self):
+		if self.max_line_bytes < self.size:
+			size = self.size
+			(self.chunks, self.size) = ([], 0)
+			raise LineTooLong('request exceeds {} bytes without a newline ({} bytes)'.
+							  format(self.max_line_bytes, size))
+
+
+class FrameBuffer(object):
+	# Reassembles the length-prefixed frames of a connection switched to the
+	# binary protocol (see wire.py) from arbitrary recv() chunks
+	def __init__(self, max_frame_bytes=MAX_LINE_BYTES):
+		self.max_frame_bytes = max_frame_bytes
+		self.chunks = []		# received after the last complete frame
+		self.size = 0
+		self.needed = FRAME_HEADER.size		# bytes completing the next frame (or its header)
+
+	def feed(self, data):
+		# Returns the body of every frame completed by data
+		self.chunks.append(data)
+		self.size += len(data)
+		if self.size < self.needed:
+			return []
+		buf = ''.join(self.chunks)
+		frames = []
+		pos = 0
+		self.needed = FRAME_HEADER.size
+		while FRAME_HEADER.size <= len(buf) - pos:
+			(size,) = FRAME_HEADER.unpack_from(buf, pos)
+			if self.max_frame_bytes < size:
+				self.flush()
+				raise LineTooLong('request exceeds {} bytes ({} bytes)'.format(self.max_frame_bytes, size))
+			end = pos + FRAME_HEADER.size + size
+			if len(buf) < end:
+				self.needed = end - pos
+				break
+			frames.append(buf[pos + FRAME_HEADER.size:end])
+			pos = end
+		tail = buf[pos:]
+		(self.chunks, self.size) = ([tail], len(tail))
+		return frames
+
+	def flush(self):
+		# An unfinished frame left when the peer closes the connection is dropped
+		(self.chunks, self.size, self.needed) = ([], 0, FRAME_HEADER.size)
+		return []
+
+
+def strip_line(line):
+	return line[:-1] if line.endswith('\r') else line
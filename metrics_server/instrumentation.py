@@ -0,0 +1,187 @@
+import bisect
+import logging
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from threading import Lock, Thread
+
+# Constants
+LATENCY_BUCKETS_SEC = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+					   0.1, 0.25, 0.5, 1.0, 2.5]
+LOG_LEVELS = ['debug', 'info', 'warning', 'error']
+LOG_LINES_PER_SEC = 10			# per message, the rest are counted and summarized
+METRIC_PREFIX = 'metrics_server_'
+
+
+class LatencyHistogram(object):
+	# Counts of durations in fixed buckets, cheap enough for every request
+	def __init__(self, bounds=LATENCY_BUCKETS_SEC):
+		self.bounds = bounds
+		self.counts = [0] * (len(bounds) + 1)	# the last one is +Inf
+		self.count = 0
+		self.sum = 0.0
+
+	def observe(self, sec):
+		self.counts[bisect.bisect_left(self.bounds, sec)] += 1
+		self.count += 1
+		self.sum += sec
+
+	def quantile(self, q):
+		# Upper bound of the bucket holding the q-quantile
+		rank = q * self.count
+		total = 0
+		for (bound, count) in zip(self.bounds + [float('inf')], self.counts):
+			total += count
+			if rank <= total and 0 < total:
+				return bound
+		return 0.0
+
+	def summary(self):
+		return {'count': self.count, 'mean': self.sum / self.count if 0 < self.count else 0.0,
+				'p50': self.quantile(0.5), 'p99': self.quantile(0.99)}
+
+
+class ServerStats(object):
+	# Counters of the server itself, reported by the stats command and, if
+	# enabled, as Prometheus text over HTTP; gauges are read when reported
+	def __init__(self):
+		self.start_time = time.time()
+		self.requests = {}		# command -> count
+		self.errors = {}		# command -> count of error responses
+		self.latencies = {}		# command -> LatencyHistogram
+		self.derived = {}		# derived value class -> LatencyHistogram
+		self.connections = 0
+		self.total_connections = 0
+		self.bytes_in = 0
+		self.bytes_out = 0
+		self.gauges = {}		# name -> function returning a number
+		self.lock = Lock()
+
+	def count_request(self, cmd, sec, ok=True):
+		with self.lock:
+			self.requests[cmd] = self.requests.get(cmd, 0) + 1
+			if not ok:
+				self.errors[cmd] = self.errors.get(cmd, 0) + 1
+			if cmd not in self.latencies:
+				self.latencies[cmd] = LatencyHistogram()
+			self.latencies[cmd].observe(sec)
+
+	def count_error(self, cmd):
+		with self.lock:
+			self.errors[cmd] = self.errors.get(cmd, 0) + 1
+
+	def time_derived(self, name, sec):
+		with self.lock:
+			if name not in self.derived:
+				self.derived[name] = LatencyHistogram()
+			self.derived[name].observe(sec)
+
+	def received(self, num_bytes):
+		with self.lock:
+			self.bytes_in += num_bytes
+
+	def sent(self, num_bytes):
+		with self.lock:
+			self.bytes_out += num_bytes
+
+	def connection_opened(self):
+		with self.lock:
+			self.connections += 1
+			self.total_connections += 1
+
+	def connection_closed(self):
+		with self.lock:
+			self.connections -= 1
+
+	def gauge(self, name, read):
+		self.gauges[name] = read
+
+	def snapshot(self):
+		with self.lock:
+			return {'uptime_sec': time.time() - self.start_time,
+					'requests': dict(self.requests), 'errors': dict(self.errors),
+					'latency_sec': dict((cmd, h.summary()) for (cmd, h) in self.latencies.items()),
+					'derived_sec': dict((name, h.summary()) for (name, h) in self.derived.items()),
+					'connections': {'current': self.connections, 'total': self.total_connections},
+					'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+					'gauges': dict((name, read()) for (name, read) in self.gauges.items())}
+
+	def prometheus(self):
+		# The same numbers in the Prometheus text exposition format
+		lines = []
+		def metric(name, kind, samples):
+			lines.append('# TYPE {}{} {}'.format(METRIC_PREFIX, name, kind))
+			for (suffix, labels, val) in samples:
+				label_text = ','.join(['{}="{}"'.format(k, v) for (k, v) in labels])
+				lines.append('{}{}{}{} {!r}'.format(METRIC_PREFIX, name, suffix,
+												   '{' + label_text + '}' if label_text else '', val))
+		def histograms(name, label, hists):
+			samples = []
+			for (key, h) in sorted(hists.items()):
+				total = 0
+				for (bound, count) in zip(h.bounds + [float('inf')], h.counts):
+					total += count
+					le = '+Inf' if bound == float('inf') else repr(bound)
+					samples.append(('_bucket', [(label, key), ('le', le)], total))
+				samples += [('_sum', [(label, key)], h.sum), ('_count', [(label, key)], h.count)]
+			metric(name, 'histogram', samples)
+		with self.lock:
+			metric('requests_total', 'counter', [('', [('command', cmd)], n) for (cmd, n) in sorted(self.requests.items())])
+			metric('errors_total', 'counter', [('', [('command', cmd)], n) for (cmd, n) in sorted(self.errors.items())])
+			histograms('request_seconds', 'command', self.latencies)
+			histograms('derived_seconds', 'derived', self.derived)
+			metric('connections', 'gauge', [('', [], self.connections)])
+			metric('connections_total', 'counter', [('', [], self.total_connections)])
+			metric('received_bytes_total', 'counter', [('', [], self.bytes_in)])
+			metric('sent_bytes_total', 'counter', [('', [], self.bytes_out)])
+		for (name, read) in sorted(self.gauges.items()):
+			metric(name, 'gauge', [('', [], read())])
+		return '\n'.join(lines) + '\n'
+
+
+def serve_prometheus(stats, port):
+	# Serves stats.prometheus() at http://<host>:<port>/metrics from a daemon thread
+	class Handler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			if self.path != '/metrics':
+				self.send_error(404)
+				return
+			body = stats.prometheus()
+			self.send_response(200)
+			self.send_header('Content-Type', 'text/plain; version=0.0.4')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			pass	# scrapes are not worth a line each
+
+	server = HTTPServer(('0.0.0.0', port), Handler)
+	thread = Thread(target=server.serve_forever, name='PrometheusExporter')
+	thread.daemon = True
+	thread.start()
+	return server
+
+
+class RateLimitFilter(logging.Filter):
+	# Lets at most per_sec records of the same message through each second;
+	# the first one let through afterwards tells how many were suppressed
+	def __init__(self, per_sec=LOG_LINES_PER_SEC):
+		logging.Filter.__init__(self)
+		self.per_sec = per_sec
+		self.windows = {}	# (level, message) -> [window start, count, suppressed]
+		self.lock = Lock()
+
+	def filter(self, record):
+		now = time.time()
+		with self.lock:
+			window = self.windows.setdefault((record.levelno, record.msg), [now, 0, 0])
+			if 1.0 <= now - window[0]:
+				if 0 < window[2]:
+					record.msg = '{} ({} similar messages suppressed)'.format(record.getMessage(), window[2])
+					record.args = ()
+				window[:] = [now, 0, 0]
+			if window[1] < self.per_sec:
+				window[1] += 1
+				return True
+			window[2] += 1
+			return False
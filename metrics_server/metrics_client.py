@@ -0,0 +1,231 @@
+import argparse
+import json
+import re
+import socket
+import sys
+import time
+from collections import OrderedDict
+from wire import frame, decode, BINARY_COMMAND, BINARY_REPLY, FRAME_HEADER
+
+# Constants
+METRICS_SERVER_HOST = 'localhost'
+METRICS_SERVER_PORT = 9999
+TIMEOUT_SEC = 10
+MIN_RETRY_SEC = 0.5
+MAX_RETRY_SEC = 30
+MAX_PENDING = 1024			# variables kept while the server is unreachable
+INPUT_FORMATS = ['json', 'throughput', 'csv']
+
+
+class MetricsClient(object):
+	# Persistent connection to the metrics server. set() queues samples and
+	# flush() sends them in one set request; when the server goes away the
+	# client reconnects with backoff and keeps only the newest sample of each
+	# variable queued. The server stamps samples on arrival, so a backlog sent
+	# at once would divide an outage's worth of growth by milliseconds.
+	# With binary, every connection switches to the binary protocol of wire.py.
+	def __init__(self, host=METRICS_SERVER_HOST, port=METRICS_SERVER_PORT,
+				 max_pending=MAX_PENDING, binary=False):
+		self.host = host
+		self.port = port
+		self.max_pending = max_pending
+		self.binary = binary
+		self.pending = OrderedDict()	# var -> newest unsent val
+		self.sock = None
+		self.sock_file = None
+		self.retry_sec = MIN_RETRY_SEC
+		self.next_retry = 0.0
+		self.connection_num = 0
+
+	def connect(self):
+		if self.sock is not None:
+			return True
+		if time.time() < self.next_retry:
+			return False
+		try:
+			self.sock = socket.create_connection((self.host, self.port), TIMEOUT_SEC)
+			self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			self.sock_file = self.sock.makefile('rb')
+			if self.binary:
+				self.sock.sendall(BINARY_COMMAND + '\n')
+				if self.sock_file.readline().rstrip('\r\n') != BINARY_REPLY:
+					raise socket.error('server does not support the binary protocol')
+		except socket.error as ex:
+			print('Cannot connect to {}:{}: {}, retrying in {} seconds'.
+				  format(self.host, self.port, ex, self.retry_sec))
+			self.close()
+			self.next_retry = time.time() + self.retry_sec
+			self.retry_sec = min(2 * self.retry_sec, MAX_RETRY_SEC)
+			return False
+		self.retry_sec = MIN_RETRY_SEC
+		self.connection_num += 1
+		return True
+
+	def close(self):
+		if self.sock is not None:
+			self.sock_file.close()
+			self.sock.close()
+		self.sock = None
+		self.sock_file = None
+
+	def set(self, vals):
+		# vals = {var1: val1, var2: val2, ...}
+		for var in vals:
+			self.pending.pop(var, None)
+			self.pending[var] = vals[var]
+		while self.max_pending < len(self.pending):
+			self.pending.popitem(last=False)
+
+	def flush(self):
+		# Returns whether every queued sample was accepted by the server
+		if len(self.pending) == 0:
+			return True
+		if not self.connect():
+			return False
+		try:
+			self.sock.sendall(self.encode('set', dict(self.pending)))
+			(status, payload) = self.read_response()
+		except socket.error as ex:
+			print('Lost connection to {}:{}: {}'.format(self.host, self.port, ex))
+			self.close()
+			return False
+		self.pending = OrderedDict()
+		return status == 'ok'
+
+	def request(self, cmd, args):
+		# Sends one request and returns the decoded payload of an 'ok' response
+		resp = self.exchange(cmd, args)
+		return resp[1] if resp is not None and resp[0] == 'ok' else None
+
+	def exchange(self, cmd, args, since=None):
+		# Sends one request and returns its (status, payload), None without a
+		# connection
+		if not (self.flush() and self.connect()):
+			return None
+		try:
+			self.sock.sendall(self.encode(cmd, args, since))
+			return self.read_response()
+		except socket.error as ex:
+			print('Lost connection to {}:{}: {}'.format(self.host, self.port, ex))
+			self.close()
+			return None
+
+	def get(self, vars):
+		return self.request('get', vars)
+
+	def get_changed(self, vars, since=None):
+		# Conditional get: returns (version, vals) of vars, with vals None if
+		# none of them changed after since, the version of an earlier answer.
+		# Versions only hold for the connection that returned them, as a
+		# restarted server counts from 0 again.
+		if not (self.flush() and self.connect()):
+			return None
+		valid = since is not None and since[0] == self.connection_num
+		resp = self.exchange('get', vars, since[1] if valid else -1)
+		if resp is None or resp[0] not in ['ok', 'unchanged']:
+			return None
+		if resp[0] == 'unchanged':
+			return (since, None)
+		return ((self.connection_num, resp[1]['version']), resp[1]['vals'])
+
+	def range(self, vars, since=0.0, step=0.0):
+		return self.request('range', {'vars': vars, 'since': since, 'step': step})
+
+	def subscribe(self, vars):
+		# Returns the current values of vars; updates() then yields their changes
+		vals = self.request('subscribe', vars)
+		if vals is not None:
+			self.sock.settimeout(None)	# updates may be minutes apart
+		return vals
+
+	def updates(self):
+		# Yields the payload of every update pushed to a subscribed connection
+		# (and of 'ok' responses to further subscribes) until it is lost
+		while True:
+			try:
+				(status, payload) = self.read_response()
+			except socket.error as ex:
+				print('Lost connection to {}:{}: {}'.format(self.host, self.port, ex))
+				self.close()
+				return
+			if status in ['update', 'ok'] and payload is not None:
+				yield payload
+
+	def encode(self, cmd, args, since=None):
+		# One request in the protocol of the connection
+		if self.binary:
+			return frame([cmd, args] if since is None else [cmd, args, {'since': since}])
+		request = {'args': args} if since is None else {'args': args, 'since': since}
+		return cmd + ' ' + json.dumps(request) + '\n'
+
+	def read_response(self):
+		# Returns (status, decoded payload or None) of the next response
+		if self.binary:
+			(size,) = FRAME_HEADER.unpack(self.read_exactly(FRAME_HEADER.size))
+			try:
+				(status, payload) = decode(self.read_exactly(size))
+			except (ValueError, TypeError) as ex:
+				raise socket.error('malformed response: {}'.format(ex))
+			return (status, payload)
+		resp = self.sock_file.readline()
+		if len(resp) == 0:
+			raise socket.error('connection closed by server')
+		(status, sep, payload) = resp.rstrip('\r\n').partition(' ')
+		try:
+			return (status, json.loads(payload) if sep else None)
+		except ValueError as ex:
+			raise socket.error('malformed response: {}'.format(ex))
+
+	def read_exactly(self, size):
+		data = self.sock_file.read(size)
+		if len(data) < size:
+			raise socket.error('connection closed by server')
+		return data
+
+
+def parse_json(line, var, fields):
+	# {"var1": val1, ...} as printed by offsets_monitor.py
+	return json.loads(line)
+
+def parse_throughput(line, var, fields):
+	# 'throughput: 1234.5 bytes/s' as printed by tcpdump --throughput-tracking
+	match = re.match(r'^throughput: ([0-9.]+) bytes/s', line)
+	return {var: float(match.group(1))} if match is not None else None
+
+def parse_csv(line, var, fields):
+	# '<timestamp msec>, val1, val2, ...' as printed by JmxMonitor
+	vals = [v.strip('" ') for v in line.split(',')]
+	if len(vals) != len(fields) + 1:
+		return None
+	return {var: dict((field, round(float(v), 3)) for (field, v) in zip(fields, vals[1:]))}
+
+PARSERS = {'json': parse_json, 'throughput': parse_throughput, 'csv': parse_csv}
+
+if __name__ == "__main__":
+	# Pushes samples read from stdin, replacing grep/sed/awk/nc pipelines
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-s', '--server_host', default=METRICS_SERVER_HOST, type=str)
+	parser.add_argument('-p', '--server_port', default=METRICS_SERVER_PORT, type=int)
+	parser.add_argument('-f', '--format', default='json', choices=INPUT_FORMATS)
+	parser.add_argument('-v', '--var', type=str, help='variable to set (throughput and csv formats)')
+	parser.add_argument('--fields', nargs='*', default=[], type=str,
+						help='names of the csv columns after the timestamp')
+	parser.add_argument('-b', '--binary', action='store_true',
+						help='talk to the server in the binary protocol instead of text')
+	args = parser.parse_args()
+
+	client = MetricsClient(args.server_host, args.server_port, binary=args.binary)
+	parse = PARSERS[args.format]
+	# readline() instead of iterating over stdin, which reads ahead in Python 2
+	for line in iter(sys.stdin.readline, ''):
+		try:
+			vals = parse(line.strip(), args.var, args.fields)
+		except ValueError:
+			vals = None
+		if vals is None:
+			print('Skipping: {}'.format(line.strip()))
+			continue
+		client.set(vals)
+		client.flush()
+	client.flush()
+	client.close()
@@ -1,131 +1,588 @@
+import argparse
+import errno
+import fcntl
 import json
+import logging
+import os
+import select
 import signal
-import socket 
+import socket
 import sys
-import threading
-from threading import Thread, Lock 
-from derived_values import MsgsIn, MsgsOut, OffsetLags, WaitTime
+import time
+from collections import deque
+from threading import Thread, Lock
+from brokers import ClusterTotals
+from columnar import ColumnWriter
+from derived_values import Pipelines
+from framing import LineBuffer, FrameBuffer, LineTooLong
+from instrumentation import ServerStats, RateLimitFilter, serve_prometheus, LOG_LEVELS
+from rules import Rules, load_rules, RULES_FILE
+from sampling import clock
+from store import ValueStore, ResponseCache
+from subscriptions import Subscriptions, QueueSink
+from timeseries import HistoryStore, HISTORY_SIZE
+from wal import LogWriter, replay, LOG_DIR, SEGMENT_BYTES, SEGMENT_SEC, MAX_SEGMENTS
+from wire import frame, decode, json_default, BINARY_COMMAND, BINARY_REPLY
+from workers import DerivedWorkers, NUM_WORKERS, QUEUE_SIZE, OVERFLOW_POLICIES
 
 # Constants
-TCP_IP = '0.0.0.0' 
+TCP_IP = '0.0.0.0'
 TCP_PORT = 9999
 BUFFER_SIZE = 8192
-LOG_FILE = './log.txt'
+LISTEN_BACKLOG = 1024			# number of backlogged clients
+MAX_PENDING_BYTES = 1048576		# per-connection unsent response bytes (event mode)
+SERVER_MODES = ['thread', 'event']
+CLOSE_COMMANDS = ['bye', 'quit']
+COMMANDS = ['set', 'get', 'subscribe', 'range', 'stats']
 
 # Global variables
-val_store = {}
-store_lock = Lock()
-log_lock = Lock()
-threads = [] 
-derived_values = {'offsets': [MsgsIn(), MsgsOut(), OffsetLags(), WaitTime()]}
+val_store = ValueStore()
+response_cache = ResponseCache()
+threads = []
+stats = ServerStats()
+pipelines = Pipelines(stats=stats)
+cluster = ClusterTotals()
+rules = Rules()
+history = HistoryStore()
+subscriptions = Subscriptions()
+log_writer = None
+column_writer = None
+workers = None
+log = logging.getLogger('metrics_server')
 
 def signal_handler(signal, frame):
 	print('\nCaught Ctrl-C signal!!')
-	if not f.closed:
-		print('Closing {}...'.format(LOG_FILE))
-		f.close()
+	if workers is not None:
+		workers.close()
+	if log_writer is not None:
+		print('Closing {}...'.format(log_writer.log_dir))
+		log_writer.close()
+	if column_writer is not None:
+		column_writer.close()
 	sys.exit(0)
 
-class ClientThread(Thread): 
-	def __init__(self, ip, port, conn): 
-		Thread.__init__(self) 
-		self.ip = ip 
-		self.port = port 
+def get_val(vars):
+	# a consistent view: every variable as of the same set
+	return val_store.get(vars)
+
+def get_response(vars, since, binary):
+	# The encoded response to a get, built and encoded only once per change of
+	# vars however many clients ask. A conditional get passes since, the
+	# version of its previous answer, and gets 'unchanged' until one of vars
+	# changes, or else the values with their version.
+	snapshot = val_store.snapshot
+	version = snapshot.version_of(vars)
+	if since is None:
+		build = lambda: encode_response('ok', snapshot.get(vars), binary)
+	elif version <= float(since):
+		return encode_response('unchanged', None, binary)
+	else:
+		build = lambda: encode_response('ok', {'version': version, 'vals': snapshot.get(vars)}, binary)
+	return response_cache.get((tuple(vars), since is not None, binary), version, build)
+
+def encode_response(status, payload, binary):
+	# A [status, payload] frame, or a 'status payload' line without its
+	# newline; set and 'unchanged' responses have no payload
+	if binary:
+		return frame([status, payload])
+	return status if payload is None else status + ' ' + json.dumps(payload, default=json_default)
+
+def record(var, val, now, persist):
+	history.record(var, val, now)
+	if persist and column_writer is not None:
+		column_writer.record(var, val, now)
+
+def apply_set(args, now, persist=True):
+	# Stores the variables of a set request received at now (epoch seconds)
+	# and everything derived from them in one atomic update, except the values
+	# derived by pipelines when workers compute them (never for replayed
+	# requests, which are not persisted again either); returns the derived
+	# (var, val) pairs stored here
+	# derived rates run on the monotonic clock
+	now_clock = clock() - (time.time() - now)
+	derived = []
+	changes = {}
+	# a malformed sample of any pipeline source fails the whole set before
+	# anything is stored or queued, with or without workers
+	parsed = dict((var, pipelines.get(var).parse(args[var])) for var in args if pipelines.derives(var))
+	for var in args:
+		new_vars = []
+		if var in parsed:
+			if workers is not None and persist:
+				workers.submit(var, parsed[var], now, now_clock)
+			else:
+				for (new_var, new_val) in derive(var, parsed[var], now, now_clock, persist):
+					derived.append((new_var, new_val))
+					changes[new_var] = new_val
+					new_vars = new_vars + [new_var]
+		if var not in new_vars:
+			changes[var] = args[var]
+			# raw inputs of derived values (e.g. per-partition offsets)
+			# are not kept, only what is derived from them
+			if not pipelines.derives(var):
+				record(var, args[var], now, persist)
+		# samples of one broker ('jmx@kafka1') also update the cluster totals ('jmx')
+		for (new_var, new_val) in cluster.update(var, args[var], now):
+			record(new_var, new_val, now, persist)
+			derived.append((new_var, new_val))
+			changes[new_var] = new_val
+	return derived + commit(changes, now, now_clock, persist)
+
+def derive(var, val, now, now_clock, persist):
+	# Runs the pipeline of source variable var; returns its (var, val) pairs
+	results = pipelines.get(var).compute(val, now_clock)
+	for (new_var, new_val) in results:
+		record(new_var, new_val, now, persist)
+	return results
+
+def apply_derived(var, val, now, now_clock):
+	# Workers' counterpart of apply_set for one sample of a pipeline source
+	try:
+		changes = dict(derive(var, val, now, now_clock, True))
+		for (new_var, new_val) in changes.items() + commit(changes, now, now_clock, True):
+			log.debug('Derived: %s: %s', new_var, new_val)
+	except Exception as ex:
+		log.warning('%s, deriving from %.200s', ex, var)
+		stats.count_error('derived')
+
+def commit(changes, now, now_clock, persist):
+	# Evaluates the rules on changes, then stores and publishes all of them
+	# at once; returns the (var, val) pairs the rules derived
+	# configured rules derive from anything just stored, derived values included
+	start = time.time()
+	evaluated = rules.evaluate(changes, val_store.lookup, now_clock)
+	if 0 < len(rules.rules):
+		stats.time_derived('rules', time.time() - start)
+	for (new_var, new_val) in evaluated:
+		record(new_var, new_val, now, persist)
+		changes[new_var] = new_val
+	val_store.update(changes)
+	subscriptions.publish(changes)
+	return evaluated
+
+def handle_request(req, client=None):
+	# Returns the response to send back, or None if there is nothing to send;
+	# client provides the subscriber() receiving updates of subscribed variables
+	start = time.time()
+	(cmd, sep, body) = req.partition(' ')
+	if cmd not in COMMANDS or (cmd == 'subscribe' and client is None):
+		log.warning('Received non-supported command: %.200s', req)
+		stats.count_request('unsupported', time.time() - start)
+		return None
+	try:
+		# format: <command> {'args': ...}, e.g. get {'args': [var1, var2, ...]},
+		# and get {'args': [...], 'since': version} for a conditional get
+		json_data = json.loads(body) if 0 < len(body) else {'args': None}
+		if cmd == 'get':
+			resp = get_response(json_data['args'], json_data.get('since'), False)
+		else:
+			resp = encode_response('ok', execute(cmd, json_data['args'], client, req), False)
+	except Exception as ex:
+		log.warning('%s, received command: %.200s', ex, req)
+		resp = 'error'
+	log.debug('Response: %.200s', resp)
+	stats.count_request(cmd, time.time() - start, resp != 'error')
+	return resp
+
+def handle_frame(data, client):
+	# The binary counterpart of handle_request: data is the body of a
+	# [command, args] or [command, args, {'since': version}] frame, answered
+	# with a [status, payload] frame
+	start = time.time()
+	try:
+		(cmd, args, options) = (decode(data) + [{}])[:3]
+	except (ValueError, TypeError) as ex:
+		log.warning('%s, received frame of %d bytes', ex, len(data))
+		stats.count_request('unsupported', time.time() - start, False)
+		return frame(['error', None])
+	if cmd not in COMMANDS:
+		log.warning('Received non-supported command: %.200s', cmd)
+		stats.count_request('unsupported', time.time() - start, False)
+		return frame(['error', None])
+	try:
+		if cmd == 'get':
+			resp = get_response(args, options.get('since'), True)
+		else:
+			resp = encode_response('ok', execute(cmd, args, client), True)
+		ok = True
+	except Exception as ex:
+		log.warning('%s, received binary command: %s', ex, cmd)
+		(resp, ok) = (frame(['error', None]), False)
+	stats.count_request(str(cmd), time.time() - start, ok)
+	return resp
+
+def execute(cmd, args, client, req=None):
+	# Runs one decoded request other than get and returns the payload of its
+	# response (None for set); req is the text of a text request, logged as it is
+	if cmd == 'set':
+		# args = {var1: val1, var2: val2, ...}
+		now = time.time()
+		if log_writer is not None:
+			log_writer.write(now, req if req is not None else
+							 lambda: 'set ' + json.dumps({'args': args}, default=json_default))
+		for (new_var, new_val) in apply_set(args, now):
+			log.debug('Derived: %s: %s', new_var, new_val)
+		return None
+	elif cmd == 'subscribe':
+		# args = [var1, var2, ...]; responds with the current values, then
+		# streams 'update {var: val, ...}' with the subscribed variables
+		# changed by each set
+		subscriptions.subscribe(client.subscriber(), args, client.binary)
+		return get_val(args)
+	elif cmd == 'range':
+		# args = {'vars': [var1, var2, ...], 'since': ts, 'step': sec}
+		return history.range(args['vars'], float(args.get('since', 0.0)), float(args.get('step', 0.0)))
+	else:
+		return stats.snapshot()
+
+def handle_requests(reqs, client=None):
+	# Handles every request framed out of one recv() in order; returns their
+	# newline-terminated responses joined for a single send, and whether the
+	# client asked to close the connection. 'binary' switches the connection
+	# to frames once answered, so the client waits for the answer before
+	# sending any.
+	resps = []
+	for req in reqs:
+		if req in CLOSE_COMMANDS:
+			return (''.join(resps), True)
+		if req == BINARY_COMMAND and client is not None:
+			client.binary = True
+			resps.append(BINARY_REPLY + '\n')
+			break
+		resp = handle_request(req, client)
+		if resp is not None:
+			resps.append(resp + '\n')
+	return (''.join(resps), False)
+
+def handle_frames(frames, client):
+	return (''.join([handle_frame(data, client) for data in frames]), False)
+
+def error_response(binary):
+	return frame(['error', None]) if binary else 'error\n'
+
+
+class ClientThread(Thread):
+	def __init__(self, ip, port, conn):
+		Thread.__init__(self)
+		self.ip = ip
+		self.port = port
 		self.conn = conn
+		self.send_lock = Lock()		# responses and subscription updates share conn
+		self.sink = None
+		self.binary = False			# switched to frames by the 'binary' request
 
-	def dbg_print(self, msg):
-		print '{}: {}'.format(threading.current_thread().name, msg)
+	def subscriber(self):
+		if self.sink is None:
+			self.sink = QueueSink(self.send)
+		return self.sink
 
-	def set_val(self, var, val):
-		# print 'Acquiring lock'
-		store_lock.acquire()
+	def send(self, data):
+		with self.send_lock:
+			self.conn.sendall(data)
+		stats.sent(len(data))
+
+	def run(self):
+		log.debug('[+] New server socket thread started for %s:%s', self.ip, self.port)
+		stats.connection_opened()
+
+		(lines, frames) = (LineBuffer(), FrameBuffer())
 		try:
-			val_store[var] = val
+			while True:
+				data = self.conn.recv(BUFFER_SIZE)
+				stats.received(len(data))
+
+				# handing requests
+				binary = self.binary
+				buf = frames if binary else lines
+				try:
+					reqs = buf.feed(data) if 0 < len(data) else buf.flush()
+				except LineTooLong as ex:
+					log.warning('%s from %s:%s', ex, self.ip, self.port)
+					stats.count_error('framing')
+					self.send(error_response(binary))
+					break
+				# updates published while the requests are handled (to this
+				# connection's own subscribe, or by its own sets) wait for the
+				# responses, which the client reads in order of its requests
+				with self.send_lock:
+					(resp, close) = handle_frames(reqs, self) if binary else handle_requests(reqs, self)
+					if 0 < len(resp):
+						self.conn.sendall(resp)
+						stats.sent(len(resp))
+				if close or len(data) == 0:
+					break
+		except socket.error as ex:
+			log.debug('%s from %s:%s', ex, self.ip, self.port)	# e.g. reset by the client
 		finally:
-			# print 'Releasing lock'
-			store_lock.release()
+			if self.sink is not None:
+				subscriptions.unsubscribe(self.sink)
+				self.sink.close()
+			self.conn.close()
+			stats.connection_closed()
+		log.debug('[-] Terminating thread for %s:%s', self.ip, self.port)
+
+
+class EventSink(object):
+	# Event-mode connection as a subscriber: updates join its output buffer
+	def __init__(self, server, fd):
+		self.server = server
+		self.fd = fd
+		self.binary = False
+
+	def subscriber(self):
+		return self
+
+	def push(self, line):
+		self.server.push(self, line)
+
 
-	def get_val(self, vars):
-		vals = {}
-		for var in vars:
-			vals[var] = val_store[var] if var in val_store else None
-		return vals
+class EventLoopServer(object):
+	# Single-threaded server multiplexing all connections with poll(2), so the
+	# number of clients is bounded by file descriptors rather than threads
+	def __init__(self, server_sock):
+		self.server_sock = server_sock
+		self.poller = select.poll()
+		self.conns = {}			# fd -> socket
+		self.addrs = {}			# fd -> (ip, port)
+		self.lines = {}			# fd -> LineBuffer of partially received requests
+		self.frames = {}		# fd -> FrameBuffer, once switched to binary
+		self.sinks = {}			# fd -> EventSink
+		self.out_bufs = {}		# fd -> unsent response bytes
+		# updates published by worker threads are handed to the loop, which
+		# alone touches the connections; a byte on the pipe wakes it up
+		self.pushed = deque()	# (EventSink, update) not sent yet
+		self.pushed_lock = Lock()
+		(self.wakeup_fd, self.wakeup_write_fd) = os.pipe()
+		for fd in (self.wakeup_fd, self.wakeup_write_fd):
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
 
-	def write_log(self, data):
-		log_lock.acquire()
+	def serve_forever(self):
+		self.server_sock.setblocking(0)
+		self.poller.register(self.server_sock.fileno(), select.POLLIN)
+		self.poller.register(self.wakeup_fd, select.POLLIN)
+		while True:
+			try:
+				events = self.poller.poll()
+			except select.error as ex:
+				if ex.args[0] == errno.EINTR:
+					continue
+				raise
+			for (fd, event) in events:
+				if fd == self.server_sock.fileno():
+					self.accept()
+				elif fd == self.wakeup_fd:
+					self.send_pushed()
+				elif fd not in self.conns:
+					continue	# closed while handling an earlier event of this poll
+				elif event & (select.POLLERR | select.POLLNVAL):
+					self.close(fd)
+				else:
+					if event & (select.POLLIN | select.POLLHUP):
+						self.read(fd)
+					if event & select.POLLOUT and fd in self.conns:
+						self.flush(fd)
+
+	def accept(self):
+		while True:
+			try:
+				(conn, (ip, port)) = self.server_sock.accept()
+			except socket.error as ex:
+				if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+					return
+				raise
+			conn.setblocking(0)
+			fd = conn.fileno()
+			self.conns[fd] = conn
+			self.addrs[fd] = (ip, port)
+			self.lines[fd] = LineBuffer()
+			self.frames[fd] = FrameBuffer()
+			self.sinks[fd] = EventSink(self, fd)
+			self.out_bufs[fd] = ''
+			self.poller.register(fd, select.POLLIN)
+			stats.connection_opened()
+			log.debug('[+] New connection from %s:%s', ip, port)
+
+	def read(self, fd):
 		try:
-			f.write(data)
-		finally:
-			log_lock.release()
-
-	def run(self): 
-		self.dbg_print('[+] New server socket thread started for {}:{}'.format(ip, port))
-
-		while True: 
-			self.dbg_print('Server blocked on recv')
-			req = self.conn.recv(BUFFER_SIZE)
-			req = req[:-1] if req.endswith('\n') else req
-			req = req[:-1] if req.endswith('\r') else req
-			self.dbg_print('Server received {} bytes: {}'.format(len(req), req))
-
-			# handing requests
-			if len(req) == 0 or req == 'bye' or req == 'quit':
-				self.conn.close()
-				break
-			elif req.startswith('set'):
-				# format: set {'args': {var1: val1, var2: val2, ...}}
-				self.write_log(req + '\n')
-				try:
-					json_data = json.loads(req[4:])
-					args = json_data['args']
-					for var in args:
-						new_vars = []
-						if derived_values.has_key(var):
-							for derived_value in derived_values[var]:
-								(new_var, new_val) = derived_value.compute(args[var])
-								self.set_val(new_var, new_val)
-								self.dbg_print('Derived: {}: {}'.format(new_var, new_val))
-								new_vars = new_vars + [new_var]
-						if var not in new_vars:
-							self.set_val(var, args[var])
-					resp = 'ok'
-				except Exception as ex:
-					self.dbg_print('{}, received command: {}'.format(ex, req))
-					resp = 'error'
-				self.dbg_print('Response: ' + resp)
-				self.conn.send(resp)
-			elif req.startswith('get'):
-				# format: get {'args': [var1, var2, ...]}
-				try:
-					json_data = json.loads(req[4:])
-					vars = json_data['args']
-					vals = self.get_val(vars)
-					resp = 'error' if vals == 'None' else 'ok ' + json.dumps(vals)
-				except Exception as ex:
-					self.dbg_print('{}, received command: {}'.format(ex, req))
-				self.dbg_print('Response: ' + resp)
-				self.conn.send(resp)
+			data = self.conns[fd].recv(BUFFER_SIZE)
+		except socket.error as ex:
+			if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+				return
+			data = ''
+		stats.received(len(data))
+		sink = self.sinks[fd]
+		binary = sink.binary
+		buf = self.frames[fd] if binary else self.lines[fd]
+		try:
+			reqs = buf.feed(data) if 0 < len(data) else buf.flush()
+		except LineTooLong as ex:
+			log.warning('%s from %s:%s', ex, *self.addrs[fd])
+			stats.count_error('framing')
+			(resp, close) = (error_response(binary), True)
+		else:
+			(resp, close) = handle_frames(reqs, sink) if binary else handle_requests(reqs, sink)
+		if 0 < len(resp) and fd in self.conns:
+			self.send(fd, resp)
+		if (close or len(data) == 0) and fd in self.conns:
+			self.close(fd)
+
+	def push(self, sink, update):
+		# Called from any thread
+		with self.pushed_lock:
+			self.pushed.append((sink, update))
+			wakeup = len(self.pushed) == 1
+		if wakeup:
+			try:
+				os.write(self.wakeup_write_fd, 'w')
+			except OSError as ex:
+				if ex.errno != errno.EAGAIN:	# a full pipe wakes the loop anyway
+					raise
+
+	def send_pushed(self):
+		try:
+			os.read(self.wakeup_fd, BUFFER_SIZE)
+		except OSError as ex:
+			if ex.errno != errno.EAGAIN:
+				raise
+		with self.pushed_lock:
+			(pushed, self.pushed) = (self.pushed, deque())
+		for (sink, update) in pushed:
+			# the connection may have closed, its fd even reused, meanwhile
+			if self.sinks.get(sink.fd) is sink:
+				self.send(sink.fd, update)
+
+	def send(self, fd, resp):
+		self.out_bufs[fd] += resp
+		if MAX_PENDING_BYTES < len(self.out_bufs[fd]):
+			log.warning('Dropping %s:%s, too many unread responses', *self.addrs[fd])
+			self.close(fd)
+			return
+		self.flush(fd)
+
+	def flush(self, fd):
+		try:
+			sent = self.conns[fd].send(self.out_bufs[fd])
+		except socket.error as ex:
+			if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+				sent = 0
 			else:
-				self.dbg_print('Received non-supported command: {}'.format(req))
-				
-		self.dbg_print('[-] Terminating thread for {}:{}'.format(self.ip, self.port))
-
-signal.signal(signal.SIGINT, signal_handler)
-
-print('Opening {}'.format(LOG_FILE))
-f = open(LOG_FILE, 'w')
-
-server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
-server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) 
-server_sock.bind((TCP_IP, TCP_PORT)) 
-
-while True: 
-	server_sock.listen(4)		# number of backlogged clients
-	print('Data server listening on port {}'.format(TCP_PORT))
-	(conn, (ip, port)) = server_sock.accept() 
-	thread = ClientThread(ip, port, conn) 
-	thread.start() 
-	threads.append(thread)
-	
-for t in threads: 
-	t.join() 
+				self.close(fd)
+				return
+		stats.sent(sent)
+		self.out_bufs[fd] = self.out_bufs[fd][sent:]
+		if len(self.out_bufs[fd]) == 0:
+			self.poller.modify(fd, select.POLLIN)
+		else:
+			self.poller.modify(fd, select.POLLIN | select.POLLOUT)
+
+	def close(self, fd):
+		if fd not in self.conns:
+			return
+		subscriptions.unsubscribe(self.sinks[fd])
+		self.poller.unregister(fd)
+		self.conns[fd].close()
+		stats.connection_closed()
+		log.debug('[-] Closed connection from %s:%s', *self.addrs[fd])
+		del self.conns[fd]
+		del self.addrs[fd]
+		del self.lines[fd]
+		del self.frames[fd]
+		del self.sinks[fd]
+		del self.out_bufs[fd]
+
+
+def run_thread_server(server_sock):
+	while True:
+		(conn, (ip, port)) = server_sock.accept()
+		thread = ClientThread(ip, port, conn)
+		thread.start()
+		# forget terminated threads so the list does not grow forever
+		threads[:] = [t for t in threads if t.is_alive()]
+		threads.append(thread)
+
+def run_event_server(server_sock):
+	EventLoopServer(server_sock).serve_forever()
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-p', '--port', default=TCP_PORT, type=int)
+	parser.add_argument('-m', '--mode', default='thread', choices=SERVER_MODES,
+						help='one thread per connection, or a single event loop')
+	parser.add_argument('-s', '--history_size', default=HISTORY_SIZE, type=int,
+						help='samples kept per series for range queries')
+	parser.add_argument('-l', '--log_dir', default=LOG_DIR, type=str,
+						help='directory of the request log segments')
+	parser.add_argument('--segment_bytes', default=SEGMENT_BYTES, type=int)
+	parser.add_argument('--segment_sec', default=SEGMENT_SEC, type=int)
+	parser.add_argument('--max_segments', default=MAX_SEGMENTS, type=int)
+	parser.add_argument('-r', '--replay', default=0, type=int, metavar='SEGMENTS',
+						help='rebuild the store from the most recent log segments at startup')
+	parser.add_argument('-d', '--data_dir', type=str,
+						help='persist every series to column files in this directory')
+	parser.add_argument('--rules', default=RULES_FILE, type=str,
+						help='JSON file of derived series rules')
+	parser.add_argument('--log_level', default='info', choices=LOG_LEVELS,
+						help='debug logs every request and connection')
+	parser.add_argument('--stats_port', type=int,
+						help='serve the stats in Prometheus text format at :<port>/metrics')
+	parser.add_argument('-w', '--workers', default=NUM_WORKERS, type=int,
+						help='threads computing derived values after sets are acknowledged '
+						'(0: compute them before acknowledging)')
+	parser.add_argument('--queue_size', default=QUEUE_SIZE, type=int,
+						help='samples waiting per worker')
+	parser.add_argument('--overflow', default='coalesce', choices=OVERFLOW_POLICIES,
+						help='what happens to samples arriving at a full worker queue')
+	args = parser.parse_args()
+	logging.basicConfig(format='%(asctime)s %(threadName)s %(levelname)s: %(message)s',
+						level=getattr(logging, args.log_level.upper()))
+	log.addFilter(RateLimitFilter())
+	history = HistoryStore(args.history_size)
+	if os.path.exists(args.rules):
+		rules = load_rules(args.rules)
+		print('Loaded {} rules from {}'.format(len(rules.rules), args.rules))
+
+	signal.signal(signal.SIGINT, signal_handler)
+
+	if 0 < args.replay:
+		start = time.time()
+		(count, skipped) = replay(args.log_dir, lambda req, now: apply_set(json.loads(req[4:])['args'], now, False),
+								  args.replay)
+		print('Replayed {} requests from {} in {:.1f} seconds, skipped {} bad lines'.
+			  format(count, args.log_dir, time.time() - start, skipped))
+
+	print('Logging requests to {}'.format(args.log_dir))
+	log_writer = LogWriter(args.log_dir, args.segment_bytes, args.segment_sec, args.max_segments)
+	log_writer.start()
+
+	if args.data_dir is not None:
+		print('Persisting series to {}'.format(args.data_dir))
+		column_writer = ColumnWriter(args.data_dir)
+		column_writer.start()
+
+	if 0 < args.workers:
+		workers = DerivedWorkers(apply_derived, args.workers, args.queue_size, args.overflow, stats)
+		stats.gauge('derived_queue_depth', workers.depth)
+		stats.gauge('derived_dropped_samples', workers.dropped)
+		stats.gauge('derived_coalesced_samples', workers.coalesced)
+
+	stats.gauge('subscribers', lambda: len(subscriptions))
+	stats.gauge('cached_responses', lambda: len(response_cache))
+	stats.gauge('response_cache_hits', lambda: response_cache.hits)
+	stats.gauge('response_cache_misses', lambda: response_cache.misses)
+	stats.gauge('log_dropped_requests', lambda: log_writer.dropped)
+	if column_writer is not None:
+		stats.gauge('column_dropped_samples', lambda: column_writer.dropped)
+	if args.stats_port is not None:
+		serve_prometheus(stats, args.stats_port)
+		print('Serving stats at http://{}:{}/metrics'.format(TCP_IP, args.stats_port))
+
+	server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	server_sock.bind((TCP_IP, args.port))
+	server_sock.listen(LISTEN_BACKLOG)
+	print('Data server listening on port {} ({} mode)'.format(args.port, args.mode))
+
+	if args.mode == 'event':
+		run_event_server(server_sock)
+	else:
+		run_thread_server(server_sock)
@@ -0,0 +1,183 @@
+import ast
+import bisect
+import json
+import os
+import re
+from collections import deque, Mapping
+from threading import Lock
+from derived_values import SlidingWindow, split_namespace, MIN_RATE_INTERVAL_SEC
+from timeseries import FIELD_SEPARATOR
+
+# Constants
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules.json')
+REFERENCE = re.compile(r'\{([^{}]+)\}')		# {var#field} in expressions
+EXPR_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Num, ast.Name, ast.Load,
+			  ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod, ast.Pow, ast.USub, ast.UAdd)
+EXPR_FUNCTIONS = {'min': min, 'max': max, 'abs': abs}
+
+# Rules are a JSON list, evaluated in order, each defining one derived series:
+#   {"var": "msgsize", "expr": "{jmx#bytesin_1min} / {jmx#msgsin_1min}"}
+#   {"var": "bytesin_rate", "rate": "jmx#bytesin_total", "window_sec": 60}
+#   {"var": "lags_p99", "percentile": 99, "of": "lags#max", "window_sec": 600}
+#   {"var": "lag_total", "sum": "offsets", "field": "lag"}
+# Inputs of namespaced variables resolve within the namespace that changed,
+# e.g. a rule on 'lags#max' derives 'lags_p99/<topic>/<group>' from
+# 'lags/<topic>/<group>'.
+
+
+def parse_reference(ref):
+	# 'jmx#bytesin_1min' -> ('jmx', ['bytesin_1min'])
+	keys = ref.strip().split(FIELD_SEPARATOR)
+	return (keys[0], keys[1:])
+
+def field(val, keys):
+	for key in keys:
+		if not isinstance(val, Mapping) or key not in val:
+			return None
+		val = val[key]
+	return val
+
+
+class Expression(object):
+	# Arithmetic over the current values of other series; stateless
+	def __init__(self, spec):
+		refs = []
+		def name(match):
+			refs.append(match.group(1))
+			return '_{}'.format(len(refs) - 1)
+		tree = ast.parse(REFERENCE.sub(name, spec['expr']).strip(), mode='eval')
+		names = set(['_{}'.format(i) for i in range(len(refs))]) | set(EXPR_FUNCTIONS)
+		for node in ast.walk(tree):
+			if not isinstance(node, EXPR_NODES) or (isinstance(node, ast.Name) and node.id not in names):
+				raise ValueError('{}: unsupported expression {!r}'.format(spec['var'], spec['expr']))
+		self.code = compile(tree, spec['var'], 'eval')
+		self.inputs = [parse_reference(ref) for ref in refs]
+
+	def new_state(self):
+		return None
+
+	def evaluate(self, vals, now, state):
+		env = dict(EXPR_FUNCTIONS)
+		for (i, val) in enumerate(vals):
+			env['_{}'.format(i)] = float(val)	# true division
+		return eval(self.code, {'__builtins__': {}}, env)
+
+
+class Rate(object):
+	# Per-second change of a counter, averaged over window_sec if given
+	def __init__(self, spec):
+		self.inputs = [parse_reference(spec['rate'])]
+		self.window_sec = spec.get('window_sec')
+
+	def new_state(self):
+		return {'last': None, 'window': SlidingWindow(self.window_sec) if self.window_sec else None}
+
+	def evaluate(self, vals, now, state):
+		last = state['last']
+		if last is not None and 0 <= now - last[0] < MIN_RATE_INTERVAL_SEC and last[1] <= vals[0]:
+			return None		# too close to the previous sample, which stays the base
+		state['last'] = (now, float(vals[0]))
+		if last is None or now < last[0] or vals[0] < last[1]:
+			return None		# first sample, out-of-order sample or counter reset
+		delta = vals[0] - last[1]
+		if state['window'] is None:
+			return delta / (now - last[0])
+		state['window'].add(now, delta)
+		return state['window'].rate(now)
+
+
+class Percentile(object):
+	# Percentile of a series' values during the last window_sec seconds. The
+	# values of the window are also kept sorted, each sample inserted and
+	# expired by binary search, so the percentile is read off by index
+	# (interpolated like np.percentile) rather than sorting the whole window.
+	def __init__(self, spec):
+		self.inputs = [parse_reference(spec['of'])]
+		self.percentile = float(spec['percentile'])
+		self.window_sec = float(spec['window_sec'])
+
+	def new_state(self):
+		return {'window': deque(), 'sorted': []}
+
+	def evaluate(self, vals, now, state):
+		(window, ordered) = (state['window'], state['sorted'])
+		val = float(vals[0])
+		window.append((now, val))
+		bisect.insort(ordered, val)
+		while self.window_sec < now - window[0][0]:
+			del ordered[bisect.bisect_left(ordered, window.popleft()[1])]
+		rank = self.percentile / 100.0 * (len(ordered) - 1)
+		lo = int(rank)
+		hi = min(lo + 1, len(ordered) - 1)
+		return ordered[lo] + (ordered[hi] - ordered[lo]) * (rank - lo)
+
+
+class Sum(object):
+	# Sum over the children of a series, e.g. a field of every partition
+	def __init__(self, spec):
+		self.inputs = [parse_reference(spec['sum'])]
+		self.keys = spec['field'].split(FIELD_SEPARATOR) if 'field' in spec else []
+
+	def new_state(self):
+		return None
+
+	def evaluate(self, vals, now, state):
+		if not isinstance(vals[0], Mapping):
+			return None
+		children = [field(child, self.keys) for child in vals[0].values()]
+		return float(sum([child for child in children if child is not None]))
+
+
+RULE_KINDS = [('expr', Expression), ('rate', Rate), ('percentile', Percentile), ('sum', Sum)]
+
+def compile_rule(spec):
+	kinds = [cls for (key, cls) in RULE_KINDS if key in spec]
+	if 'var' not in spec or len(kinds) != 1:
+		raise ValueError('Rule needs a var and one of {}: {}'.format(
+			[key for (key, cls) in RULE_KINDS], json.dumps(spec)))
+	rule = kinds[0](spec)
+	rule.var = spec['var']
+	rule.roots = set([root for (root, keys) in rule.inputs])
+	return rule
+
+
+class Rules(object):
+	# Derived series compiled once from rule specs; evaluate() runs only the
+	# rules whose inputs changed, in order, so a rule can use earlier results
+	def __init__(self, specs=[]):
+		self.rules = [compile_rule(spec) for spec in specs]
+		self.states = {}	# (rule index, namespace) -> state
+		self.lock = Lock()
+
+	def evaluate(self, changes, lookup, now):
+		# changes = {var: val} stored by one set, lookup(var) returns any other
+		# stored value, now = time on the monotonic clock; returns [(var, val)]
+		if len(self.rules) == 0:
+			return []
+		vals = dict(changes)
+		changed = set([split_namespace(var) for var in changes])
+		results = []
+		with self.lock:
+			for (i, rule) in enumerate(self.rules):
+				for namespace in sorted(set([ns for (root, ns) in changed if root in rule.roots])):
+					inputs = [field(vals[root + namespace] if root + namespace in vals
+									else lookup(root + namespace), keys) for (root, keys) in rule.inputs]
+					if None in inputs:
+						continue
+					if (i, namespace) not in self.states:
+						self.states[(i, namespace)] = rule.new_state()
+					try:
+						val = rule.evaluate(inputs, now, self.states[(i, namespace)])
+					except (ArithmeticError, TypeError, ValueError):
+						continue
+					if val is None:
+						continue
+					vals[rule.var + namespace] = val
+					changed.add((rule.var, namespace))
+					results.append((rule.var + namespace, val))
+		return results
+
+
+def load_rules(path=RULES_FILE):
+	with open(path) as f:
+		return Rules(json.load(f))
@@ -0,0 +1,48 @@
+import ctypes
+import ctypes.util
+import math
+import os
+import time
+
+# Constants
+CLOCK_MONOTONIC = 1				# from <time.h> on Linux
+HOST_SEPARATOR = '@'			# e.g. 'jmx@kafka1', 'bytesin@kafka2'
+
+
+class Timespec(ctypes.Structure):
+	_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def monotonic_clock():
+	# Monotonic clock in seconds. Python 2 has no time.monotonic, and the
+	# elapsed real time from times(2) only ticks every 10 ms, which makes rates
+	# of samples arriving close together absurd, so clock_gettime(2) is called
+	# through ctypes where the C library has it
+	if hasattr(time, 'monotonic'):
+		return time.monotonic
+	libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+	if not hasattr(libc, 'clock_gettime'):
+		return lambda: os.times()[4]
+	def clock():
+		ts = Timespec()
+		if libc.clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+			raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+		return ts.tv_sec + ts.tv_nsec * 1e-9
+	return clock
+
+clock = monotonic_clock()
+
+def fixed_rate(interval_sec, immediately=True):
+	# Yields every interval_sec seconds, first right away if immediately: the
+	# time the caller spends between ticks is taken out of the sleep, and ticks
+	# missed by a slow caller are skipped, not bunched up
+	next_time = clock()
+	if immediately:
+		yield
+	while True:
+		next_time += interval_sec
+		delay = next_time - clock()
+		if delay < 0:
+			next_time += math.ceil(-delay / interval_sec) * interval_sec
+			delay = next_time - clock()
+		time.sleep(max(0.0, delay))
+		yield
@@ -0,0 +1,129 @@
+from collections import OrderedDict
+from threading import Lock
+
+# Constants
+MAX_CACHED_RESPONSES = 256		# distinct requested-variable sets
+MAX_DELTAS = 32					# sets kept as deltas before merging them into the base
+
+
+class Snapshot(object):
+	# Immutable point-in-time view of the store; never modified once published.
+	# base holds the values as of some compaction, with the store version at
+	# which each one last changed, and deltas the (version, {var: val}) of
+	# every set applied since, newest first.
+	def __init__(self, base, base_versions, deltas, version):
+		self.base = base
+		self.base_versions = base_versions
+		self.deltas = deltas
+		self.version = version
+
+	def get(self, vars):
+		vals = {}
+		for var in vars:
+			for (version, changes) in self.deltas:
+				if var in changes:
+					vals[var] = changes[var]
+					break
+			else:
+				vals[var] = self.base.get(var)
+		return vals
+
+	def lookup(self, var):
+		for (version, changes) in self.deltas:
+			if var in changes:
+				return changes[var]
+		return self.base.get(var)
+
+	def version_of(self, vars):
+		# Latest version at which any of vars changed, 0 if none was ever set;
+		# the first delta holding any of vars has it
+		for (version, changes) in self.deltas:
+			for var in vars:
+				if var in changes:
+					return version
+		return max([self.base_versions.get(var, 0) for var in vars] + [0])
+
+
+class ValueStore(object):
+	# Copy-on-write map of the latest value of every variable. A writer
+	# publishes a new snapshot holding the set as one more delta by swapping a
+	# single reference, so readers never take a lock and a get sees either all
+	# or none of a set, and a set costs the size of the set, not of the store.
+	# Once max_deltas pile up, one writer merges them into a new base outside
+	# the lock and splices it under the deltas published meanwhile.
+	def __init__(self, max_deltas=MAX_DELTAS):
+		self.max_deltas = max_deltas
+		self.snapshot = Snapshot({}, {}, (), 0)
+		self.lock = Lock()		# writers only
+		self.compacting = False
+
+	def update(self, vals):
+		# vals = {var: val, ...} from one set request
+		if len(vals) == 0:
+			return self.snapshot
+		with self.lock:
+			current = self.snapshot
+			version = current.version + 1
+			self.snapshot = Snapshot(current.base, current.base_versions,
+									 ((version, dict(vals)),) + current.deltas, version)
+			snapshot = self.snapshot
+			compact = self.max_deltas <= len(snapshot.deltas) and not self.compacting
+			if compact:
+				self.compacting = True
+		if compact:
+			self.compact(snapshot)
+		return snapshot
+
+	def compact(self, snapshot):
+		# Merges the deltas of snapshot into a new base; only the thread that
+		# set compacting calls this, so the base cannot change meanwhile
+		base = dict(snapshot.base)
+		base_versions = dict(snapshot.base_versions)
+		for (version, changes) in reversed(snapshot.deltas):
+			base.update(changes)
+			base_versions.update((var, version) for var in changes)
+		with self.lock:
+			current = self.snapshot
+			self.snapshot = Snapshot(base, base_versions,
+									 current.deltas[:len(current.deltas) - len(snapshot.deltas)], current.version)
+			self.compacting = False
+
+	def get(self, vars):
+		return self.snapshot.get(vars)
+
+	def lookup(self, var):
+		return self.snapshot.lookup(var)
+
+
+class ResponseCache(object):
+	# Encoded responses by key (e.g. the requested variables and encoding),
+	# each valid for the version it was built at: a repeated get of variables
+	# that did not change since is answered without building or encoding
+	# anything. The oldest entry goes when max_size keys are cached.
+	def __init__(self, max_size=MAX_CACHED_RESPONSES):
+		self.max_size = max_size
+		self.responses = OrderedDict()	# key -> (version, response)
+		self.hits = 0
+		self.misses = 0
+		self.lock = Lock()
+
+	def get(self, key, version, build):
+		# Returns the response for key at version, calling build() to make it
+		# unless the cached one is of the same version
+		with self.lock:
+			cached = self.responses.get(key)
+			if cached is not None and cached[0] == version:
+				self.hits += 1
+				return cached[1]
+			self.misses += 1
+		resp = build()
+		with self.lock:
+			cached = self.responses.get(key)
+			if cached is None or cached[0] < version:
+				if cached is None and self.max_size <= len(self.responses):
+					self.responses.popitem(last=False)
+				self.responses[key] = (version, resp)
+		return resp
+
+	def __len__(self):
+		return len(self.responses)
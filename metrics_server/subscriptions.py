@@ -0,0 +1,81 @@
+import json
+from Queue import Queue, Full
+from threading import Lock, Thread
+from wire import frame, json_default
+
+# Constants
+MAX_QUEUED_UPDATES = 256		# per subscriber (thread mode); older updates are dropped
+
+
+class Subscriptions(object):
+	# Connections subscribed to variables; publish() pushes each set's changed
+	# variables to the subscribers of any of them as 'update {var: val, ...}',
+	# or as an ['update', {var: val, ...}] frame to binary connections
+	def __init__(self):
+		self.subscribers = {}	# sink -> (vars, binary)
+		self.lock = Lock()
+
+	def subscribe(self, sink, vars, binary=False):
+		with self.lock:
+			old_vars = self.subscribers.get(sink, (set(), binary))[0]
+			self.subscribers[sink] = (set(vars) | old_vars, binary)
+
+	def unsubscribe(self, sink):
+		with self.lock:
+			self.subscribers.pop(sink, None)
+
+	def __len__(self):
+		return len(self.subscribers)
+
+	def publish(self, changes):
+		# changes = {var: val} stored by one set request
+		with self.lock:
+			subscribers = self.subscribers.items()
+		encoded = {}	# subscribers of the same variables share one encoding
+		for (sink, (vars, binary)) in subscribers:
+			changed = tuple(sorted([var for var in vars if var in changes]))
+			if len(changed) == 0:
+				continue
+			if (changed, binary) not in encoded:
+				vals = dict((var, changes[var]) for var in changed)
+				encoded[(changed, binary)] = frame(['update', vals]) if binary else \
+					'update ' + json.dumps(vals, default=json_default) + '\n'
+			sink.push(encoded[(changed, binary)])
+
+
+class QueueSink(Thread):
+	# Writes updates to a thread-mode connection from its own thread, so a slow
+	# subscriber never stalls the connection that published the set; send is
+	# the connection's own (locked) send function
+	def __init__(self, send):
+		Thread.__init__(self)
+		self.daemon = True
+		self.send = send
+		self.queue = Queue(MAX_QUEUED_UPDATES)
+		self.closed = False
+		self.start()
+
+	def push(self, line):
+		try:
+			self.queue.put_nowait(line)
+		except Full:
+			pass
+
+	def close(self):
+		# Never blocks: with a full queue, the thread stops after its current
+		# update, or is gone already if sending failed
+		self.closed = True
+		try:
+			self.queue.put_nowait(None)
+		except Full:
+			pass
+
+	def run(self):
+		while True:
+			line = self.queue.get()
+			if line is None or self.closed:
+				break
+			try:
+				self.send(line)
+			except IOError:
+				break
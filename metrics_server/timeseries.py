@@ -0,0 +1,107 @@
+import numbers
+import numpy as np
+from collections import Mapping
+from threading import Lock
+
+HISTORY_SIZE = 28800		# samples kept per series (8 hours at 1 s intervals)
+MAX_SERIES = 1024			# series tracked at most, to bound memory
+FIELD_SEPARATOR = '#'		# same path separator the dashboard queries use
+
+
+class RingBuffer(object):
+	# Fixed-size, preallocated (timestamp, value) history; oldest samples are
+	# overwritten once full. Samples older than the last one (computed by
+	# another thread meanwhile) are dropped, so times stay sorted for since().
+	def __init__(self, size):
+		self.size = size
+		self.times = np.zeros(size)
+		self.vals = np.zeros(size)
+		self.count = 0		# samples appended since creation
+		self.lock = Lock()
+
+	def append(self, time, val):
+		with self.lock:
+			if 0 < self.count and time < self.times[(self.count - 1) % self.size]:
+				return
+			i = self.count % self.size
+			self.times[i] = time
+			self.vals[i] = val
+			self.count += 1
+
+	def since(self, time):
+		# Returns copies of (times, vals) at or after time, oldest first
+		with self.lock:
+			if self.count <= self.size:
+				times = self.times[:self.count].copy()
+				vals = self.vals[:self.count].copy()
+			else:
+				i = self.count % self.size
+				times = np.concatenate((self.times[i:], self.times[:i]))
+				vals = np.concatenate((self.vals[i:], self.vals[:i]))
+		start = np.searchsorted(times, time)
+		return (times[start:], vals[start:])
+
+
+class HistoryStore(object):
+	# One RingBuffer per numeric leaf of a variable, e.g. 'msgsin#msgsin_1min'
+	def __init__(self, size=HISTORY_SIZE, max_series=MAX_SERIES):
+		self.size = size
+		self.max_series = max_series
+		self.series = {}
+		self.lock = Lock()
+
+	def record(self, var, val, time):
+		for (name, leaf) in flatten(var, val):
+			buf = self.series.get(name)
+			if buf is None:
+				buf = self.add_series(name)
+				if buf is None:
+					continue
+			buf.append(time, leaf)
+
+	def add_series(self, name):
+		with self.lock:
+			if name not in self.series:
+				if self.max_series <= len(self.series):
+					return None
+				self.series[name] = RingBuffer(self.size)
+			return self.series[name]
+
+	def names(self, vars):
+		# Expands top-level variables to all of their series
+		names = []
+		for var in vars:
+			prefix = var + FIELD_SEPARATOR
+			names += [name for name in self.series.keys() if name == var or name.startswith(prefix)]
+		return names
+
+	def range(self, vars, since=0.0, step=0.0):
+		# Returns {series: {'time': [...], 'data': [...]}}, averaged into
+		# step-second buckets if step is positive
+		result = {}
+		for name in self.names(vars):
+			(times, vals) = self.series[name].since(since)
+			if 0.0 < step and 0 < len(times):
+				(times, vals) = downsample(times, vals, step)
+			result[name] = {'time': times.tolist(), 'data': vals.tolist()}
+		return result
+
+
+def flatten(var, val):
+	# Yields (name, number) for every numeric leaf of a (nested) value
+	if isinstance(val, bool):
+		return
+	if isinstance(val, numbers.Number):
+		yield (var, val)
+	elif isinstance(val, Mapping):
+		for key in val:
+			for leaf in flatten(var + FIELD_SEPARATOR + key, val[key]):
+				yield leaf
+
+def downsample(times, vals, step):
+	# Means over step-aligned buckets, stamped with the bucket start time
+	buckets = np.floor(times / step)
+	(starts, first) = np.unique(buckets, return_index=True)
+	counts = np.diff(np.append(first, len(buckets)))
+	means = np.add.reduceat(vals, first) / counts
+	return (starts * step, means)
@@ -0,0 +1,114 @@
+import os
+import re
+import time
+from Queue import Queue, Empty, Full
+from threading import Thread
+
+# Constants
+LOG_DIR = './log'
+SEGMENT_BYTES = 67108864		# rotate after this many bytes...
+SEGMENT_SEC = 3600				# ...or this many seconds, whichever comes first
+MAX_SEGMENTS = 48				# older segments are deleted
+QUEUE_SIZE = 65536				# requests waiting for the writer
+FLUSH_INTERVAL_SEC = 1.0
+SEGMENT_PATTERN = re.compile(r'^segment-(\d+)\.log$')
+
+
+def segment_paths(log_dir):
+	# Returns the segment files in log_dir, oldest first
+	if not os.path.isdir(log_dir):
+		return []
+	numbered = []
+	for name in os.listdir(log_dir):
+		match = SEGMENT_PATTERN.match(name)
+		if match is not None:
+			numbered.append((int(match.group(1)), os.path.join(log_dir, name)))
+	return [path for (num, path) in sorted(numbered)]
+
+
+class LogWriter(Thread):
+	# Appends '<timestamp> <request>' lines to size/time-rotated segments from a
+	# background thread; write() only enqueues, so ingest never waits for disk
+	def __init__(self, log_dir=LOG_DIR, segment_bytes=SEGMENT_BYTES, segment_sec=SEGMENT_SEC,
+				 max_segments=MAX_SEGMENTS):
+		Thread.__init__(self, name='LogWriter')
+		self.daemon = True
+		self.log_dir = log_dir
+		self.segment_bytes = segment_bytes
+		self.segment_sec = segment_sec
+		self.max_segments = max_segments
+		self.queue = Queue(QUEUE_SIZE)
+		self.dropped = 0
+		self.f = None
+		if not os.path.isdir(log_dir):
+			os.makedirs(log_dir)
+		paths = segment_paths(log_dir)
+		self.segment_num = int(SEGMENT_PATTERN.match(os.path.basename(paths[-1])).group(1)) \
+			if 0 < len(paths) else 0
+
+	def write(self, time, req):
+		# req is the request text, or a function returning it that the writer
+		# thread calls (binary requests are turned into text there)
+		try:
+			self.queue.put_nowait((time, req))
+		except Full:
+			self.dropped += 1
+
+	def close(self):
+		self.queue.put(None)
+		self.join()
+
+	def run(self):
+		last_flush = time.time()
+		while True:
+			try:
+				entry = self.queue.get(timeout=FLUSH_INTERVAL_SEC)
+			except Empty:
+				entry = ()
+			if entry is None:
+				break
+			if 0 < len(entry):
+				(ts, req) = entry
+				line = '{:.6f} {}\n'.format(ts, req() if callable(req) else req)
+				if self.f is None or self.should_rotate():
+					self.rotate()
+				self.f.write(line)
+				self.size += len(line)
+			now = time.time()
+			if self.f is not None and FLUSH_INTERVAL_SEC <= now - last_flush:
+				self.f.flush()
+				last_flush = now
+		if self.f is not None:
+			self.f.close()
+
+	def should_rotate(self):
+		return self.segment_bytes <= self.size or self.segment_sec <= time.time() - self.opened
+
+	def rotate(self):
+		if self.f is not None:
+			self.f.close()
+		self.segment_num += 1
+		path = os.path.join(self.log_dir, 'segment-{:06d}.log'.format(self.segment_num))
+		self.f = open(path, 'a')
+		self.size = 0
+		self.opened = time.time()
+		for old_path in segment_paths(self.log_dir)[:-self.max_segments]:
+			os.remove(old_path)
+
+
+def replay(log_dir, handler, num_segments):
+	# Calls handler(req, time) for every request in the last num_segments
+	# segments, oldest first; returns the numbers of requests replayed and of
+	# lines skipped, cut short by a crash or failing in handler
+	(count, skipped) = (0, 0)
+	for path in segment_paths(log_dir)[-num_segments:] if 0 < num_segments else []:
+		with open(path) as f:
+			for line in f:
+				(ts, sep, req) = line.rstrip('\n').partition(' ')
+				try:
+					handler(req, float(ts))
+				except Exception:
+					skipped += 1
+					continue
+				count += 1
+	return (count, skipped)
@@ -0,0 +1,353 @@
+import json
+import numbers
+import struct
+from collections import Mapping
+from operator import itemgetter
+import numpy as np
+
+# Constants
+BINARY_COMMAND = 'binary'		# text request switching a connection to frames
+BINARY_REPLY = 'ok binary'
+FRAME_HEADER = struct.Struct('>I')	# length of the encoded body that follows
+COUNT = struct.Struct('<I')
+INT = struct.Struct('<q')
+FLOAT = struct.Struct('<d')
+INT_MIN = -2 ** 63
+INT_MAX = 2 ** 63 - 1
+# Type tags
+NONE = 'N'
+TRUE = 'T'
+FALSE = 'F'
+INT_TAG = 'i'
+FLOAT_TAG = 'd'
+STR_TAG = 's'
+LIST_TAG = 'l'
+MAP_TAG = 'm'
+INTS_TAG = 'q'					# int64 array
+FLOATS_TAG = 'a'				# float64 array
+TABLE_TAG = 't'					# {row: {column: number}} as one array per column
+JSON_TAG = 'j'					# small dict or list as JSON text
+ARRAY_DTYPES = {INTS_TAG: np.dtype('<i8'), FLOATS_TAG: np.dtype('<f8')}
+INT_TYPES = set([int, long])
+FLOAT_TYPES = set([float])
+MIN_BULK_LEN = 16				# shorter lists and dicts are left to JSON text
+NAME_SEPARATOR = '\x00'		# between the row (column) names of a table
+
+# Binary framing, negotiated by sending the text request 'binary' and waiting
+# for 'ok binary'; from then on both directions carry frames of a 4-byte
+# big-endian length and a body encoding [command, args] for requests and
+# [status, payload] for responses ('ok', 'error', 'update'). Values use the
+# JSON types with numbers packed little-endian, lists of numbers and the
+# per-partition dicts of offsets samples as raw arrays, so neither side walks
+# them element by element. Small dicts and lists, like most derived values
+# and get requests and responses, are embedded as JSON text, which the json module encodes and
+# parses faster than packing each number from Python would.
+
+
+class Table(Mapping):
+	# {row: {column: number}} decoded from a table, keeping the rows in order
+	# and the columns as arrays. The dicts are only built the first time the
+	# table is used as a mapping: the server hands the arrays to the offsets
+	# pipelines and encodes them again as they are, so mostly nobody does.
+	def __init__(self, rows, columns):
+		self.rows = rows
+		self.columns = columns	# column -> array, in the order of rows
+		self.dict = None
+
+	def as_dict(self):
+		if self.dict is None:
+			names = list(self.columns)
+			lists = [self.columns[name].tolist() for name in names]
+			self.dict = dict(zip(self.rows, [dict(zip(names, vals)) for vals in zip(*lists)]))
+		return self.dict
+
+	def __getitem__(self, row):
+		return self.as_dict()[row]
+
+	def __iter__(self):
+		return iter(self.rows)
+
+	def __len__(self):
+		return len(self.rows)
+
+	def __repr__(self):
+		return repr(self.as_dict())
+
+
+def json_default(val):
+	# default= of json.dumps for values that may hold decoded tables
+	if isinstance(val, Table):
+		return val.as_dict()
+	raise TypeError('{!r} is not JSON serializable'.format(val))
+
+def frame(val):
+	body = encode(val)
+	return FRAME_HEADER.pack(len(body)) + body
+
+def encode(val):
+	out = []
+	encode_value(val, out)
+	return ''.join(out)
+
+def encode_value(val, out):
+	encoder = ENCODERS.get(type(val))
+	(encoder if encoder is not None else encoder_of(val))(val, out)
+
+def encoder_of(val):
+	# Encoder of subclasses, numpy scalars and other mappings
+	if isinstance(val, (bool, np.bool_)):
+		return encode_bool
+	for (types, encoder) in [((int, long, numbers.Integral), encode_int), ((float, numbers.Real), encode_float),
+							 (basestring, encode_string), (Mapping, encode_map), ((list, tuple), encode_list)]:
+		if isinstance(val, types):
+			return encoder
+	raise TypeError('{!r} cannot be encoded'.format(val))
+
+def encode_none(val, out):
+	out.append(NONE)
+
+def encode_bool(val, out):
+	out.append(TRUE if val else FALSE)
+
+def encode_int(val, out):
+	val = int(val)
+	if INT_MIN <= val <= INT_MAX:
+		out.append(INT_TAG + INT.pack(val))
+	else:
+		out.append(FLOAT_TAG + FLOAT.pack(val))
+
+def encode_float(val, out):
+	out.append(FLOAT_TAG + FLOAT.pack(val))
+
+def encode_string(val, out):
+	out.append(STR_TAG)
+	encode_str(val, out)
+
+def encode_map(val, out):
+	if type(val) is Table:
+		encode_table(val.rows, [(name, array_tag(array), array) for (name, array) in val.columns.items()], out)
+		return
+	if is_small(val) and encode_json(val, out):
+		return
+	table = table_columns(val)
+	if table is not None:
+		encode_table(table[0], table[1], out)
+		return
+	out.append(MAP_TAG + COUNT.pack(len(val)))
+	for (key, item) in val.items():
+		encode_str(key if isinstance(key, basestring) else str(key), out)
+		encode_value(item, out)
+
+def encode_list(val, out):
+	if type(val) is not np.ndarray and is_small(val) and encode_json(val, out):
+		return
+	array = numeric_array(val)
+	if array is not None:
+		(tag, array) = array
+		out.append(tag + COUNT.pack(len(array)) + array.astype(ARRAY_DTYPES[tag]).tostring())
+		return
+	out.append(LIST_TAG + COUNT.pack(len(val)))
+	for item in val:
+		encode_value(item, out)
+
+def encode_json(val, out):
+	# Returns whether val could be encoded as JSON text
+	try:
+		data = json.dumps(val)
+	except (TypeError, ValueError):
+		return False
+	out.append(JSON_TAG + COUNT.pack(len(data)) + data)
+	return True
+
+def encode_str(val, out):
+	data = val.encode('utf-8') if isinstance(val, unicode) else val
+	out.append(COUNT.pack(len(data)) + data)
+
+def encode_table(rows, columns, out):
+	# row and column names travel as one NUL-separated string each
+	out.append(TABLE_TAG + COUNT.pack(len(rows)))
+	encode_str(NAME_SEPARATOR.join(rows), out)
+	out.append(COUNT.pack(len(columns)))
+	encode_str(NAME_SEPARATOR.join([name for (name, tag, array) in columns]), out)
+	for (name, tag, array) in columns:
+		out.append(tag + array.astype(ARRAY_DTYPES[tag]).tostring())
+
+def array_tag(array):
+	return FLOATS_TAG if array.dtype.kind == 'f' else INTS_TAG
+
+def numeric_array(vals):
+	# (tag, array) for a non-empty sequence of only ints or only floats, None
+	# otherwise (mixed, bools, None, nested values, huge ints)
+	if len(vals) == 0:
+		return None
+	if isinstance(vals, np.ndarray):
+		kind = vals.dtype.kind
+		if vals.ndim != 1 or kind not in 'iuf':
+			return None
+		huge = kind == 'u' and INT_MAX < vals.max()
+		return (FLOATS_TAG if kind == 'f' or huge else INTS_TAG, vals)
+	types = set(map(type, vals))
+	if types <= INT_TYPES:
+		tag = INTS_TAG
+	elif types == FLOAT_TYPES:
+		tag = FLOATS_TAG
+	else:
+		# numpy scalars and other number types, one by one
+		tags = set([number_tag(v) for v in vals])
+		if len(tags) != 1 or None in tags:
+			return None
+		tag = tags.pop()
+	try:
+		return (tag, np.array(vals, dtype=ARRAY_DTYPES[tag]))
+	except (OverflowError, ValueError):
+		return None
+
+def number_tag(val):
+	if isinstance(val, (bool, np.bool_)):
+		return None
+	if isinstance(val, (int, long, np.integer)):
+		return INTS_TAG
+	return FLOATS_TAG if isinstance(val, (float, np.floating)) else None
+
+def table_columns(val):
+	# (rows, [(column, tag, array)]) for a dict of at least two dicts with the
+	# same numeric columns, e.g. the partitions of an offsets sample
+	if len(val) < 2:
+		return None
+	rows = list(val)
+	dicts = [val[row] for row in rows]
+	if not all([t is Table or issubclass(t, dict) for t in set(map(type, dicts))]) or len(dicts[0]) == 0:
+		return None
+	names = list(dicts[0])
+	if not all([is_name(name) for name in rows + names]) or set(map(len, dicts)) != set([len(names)]):
+		return None
+	try:
+		grid = map(itemgetter(*names), dicts) if 1 < len(names) else [(d[names[0]],) for d in dicts]
+	except KeyError:
+		return None
+	columns = []
+	for (name, vals) in zip(names, zip(*grid)):
+		array = numeric_array(vals)
+		if array is None:
+			return None
+		columns.append((name, array[0], array[1]))
+	return (rows, columns)
+
+def is_small(val):
+	# Whether a dict or list is short and holds no table, array or long list
+	# or dict at any depth. Types are compared as isinstance() against Table,
+	# an abstract Mapping, is slow.
+	if MIN_BULK_LEN <= len(val):
+		return False
+	for item in val.values() if isinstance(val, dict) else val:
+		t = type(item)
+		if t is Table or t is np.ndarray:
+			return False
+		if issubclass(t, (dict, list, tuple)) and not is_small(item):
+			return False
+	return True
+
+def is_name(key):
+	return isinstance(key, basestring) and NAME_SEPARATOR not in key
+
+
+def decode(data):
+	# Returns the value encoded in data; raises ValueError if it is malformed
+	try:
+		(val, pos) = decode_value(data, 0)
+	except (struct.error, KeyError, IndexError, UnicodeDecodeError) as ex:
+		raise ValueError('Malformed binary value: {}'.format(ex))
+	if pos != len(data):
+		raise ValueError('Malformed binary value: {} trailing bytes'.format(len(data) - pos))
+	return val
+
+def decode_value(data, pos):
+	return DECODERS[data[pos]](data, pos + 1)
+
+def decode_str(data, pos):
+	(size,) = COUNT.unpack_from(data, pos)
+	pos += COUNT.size
+	if len(data) < pos + size:
+		raise IndexError('string past the end')
+	return (data[pos:pos + size].decode('utf-8'), pos + size)
+
+def decode_json(data, pos):
+	(size,) = COUNT.unpack_from(data, pos)
+	pos += COUNT.size
+	if len(data) < pos + size:
+		raise IndexError('JSON text past the end')
+	return (json.loads(data[pos:pos + size]), pos + size)
+
+def decode_list(data, pos):
+	(count,) = COUNT.unpack_from(data, pos)
+	pos += COUNT.size
+	vals = []
+	for i in xrange(count):
+		(val, pos) = decode_value(data, pos)
+		vals.append(val)
+	return (vals, pos)
+
+def decode_map(data, pos):
+	(count,) = COUNT.unpack_from(data, pos)
+	pos += COUNT.size
+	vals = {}
+	for i in xrange(count):
+		(key, pos) = decode_str(data, pos)
+		(vals[key], pos) = decode_value(data, pos)
+	return (vals, pos)
+
+def decode_array(tag, data, pos):
+	(count,) = COUNT.unpack_from(data, pos)
+	pos += COUNT.size
+	(array, pos) = read_array(tag, count, data, pos)
+	return (array.tolist(), pos)
+
+def read_array(tag, count, data, pos):
+	dtype = ARRAY_DTYPES[tag]
+	end = pos + count * dtype.itemsize
+	if len(data) < end:
+		raise IndexError('array past the end')
+	return (np.frombuffer(data, dtype, count, pos), end)
+
+def decode_table(data, pos):
+	(num_rows,) = COUNT.unpack_from(data, pos)
+	(rows, pos) = decode_str(data, pos + COUNT.size)
+	(num_columns,) = COUNT.unpack_from(data, pos)
+	(names, pos) = decode_str(data, pos + COUNT.size)
+	(rows, names) = (rows.split(NAME_SEPARATOR), names.split(NAME_SEPARATOR))
+	if len(rows) != num_rows or len(names) != num_columns:
+		raise IndexError('table names do not match its size')
+	columns = {}
+	for name in names:
+		(columns[name], pos) = read_array(data[pos], num_rows, data, pos + 1)
+	return (Table(rows, columns), pos)
+
+ENCODERS = {
+	type(None): encode_none,
+	bool: encode_bool,
+	int: encode_int,
+	long: encode_int,
+	float: encode_float,
+	str: encode_string,
+	unicode: encode_string,
+	dict: encode_map,
+	Table: encode_map,
+	list: encode_list,
+	tuple: encode_list,
+	np.ndarray: encode_list,
+}
+
+DECODERS = {
+	NONE: lambda data, pos: (None, pos),
+	TRUE: lambda data, pos: (True, pos),
+	FALSE: lambda data, pos: (False, pos),
+	INT_TAG: lambda data, pos: (INT.unpack_from(data, pos)[0], pos + INT.size),
+	FLOAT_TAG: lambda data, pos: (FLOAT.unpack_from(data, pos)[0], pos + FLOAT.size),
+	STR_TAG: decode_str,
+	LIST_TAG: decode_list,
+	MAP_TAG: decode_map,
+	INTS_TAG: lambda data, pos: decode_array(INTS_TAG, data, pos),
+	FLOATS_TAG: lambda data, pos: decode_array(FLOATS_TAG, data, pos),
+	TABLE_TAG: decode_table,
+	JSON_TAG: decode_json,
+}
@@ -0,0 +1,99 @@
+import time
+from collections import deque
+from threading import Condition, Thread
+
+# Constants
+NUM_WORKERS = 2
+QUEUE_SIZE = 64					# samples waiting per worker
+OVERFLOW_POLICIES = ['coalesce', 'drop', 'block']
+CLOSE_TIMEOUT_SEC = 1.0			# per worker finishing its current sample
+
+
+class Worker(Thread):
+	# One thread of DerivedWorkers and the samples waiting for it, in order
+	def __init__(self, pool, num):
+		Thread.__init__(self, name='DerivedWorker-{}'.format(num))
+		self.daemon = True
+		self.pool = pool
+		self.pending = deque()	# [source, args, time queued]
+		self.queued = {}		# source -> its entry in pending, for coalescing
+		self.dropped = 0
+		self.coalesced = 0
+		self.cond = Condition()		# guards all of the above
+		self.start()
+
+	def run(self):
+		while True:
+			with self.cond:
+				while len(self.pending) == 0 and not self.pool.closed:
+					self.cond.wait()
+				if self.pool.closed:
+					break
+				entry = self.pending.popleft()
+				if self.queued.get(entry[0]) is entry:
+					del self.queued[entry[0]]
+				self.cond.notify_all()	# room for a blocked submit()
+			(source, args, queued_time) = entry
+			if self.pool.stats is not None:
+				self.pool.stats.time_derived('queued', time.time() - queued_time)
+			self.pool.compute(source, *args)
+
+
+class DerivedWorkers(object):
+	# Threads computing derived values off the ingest path, so a set is
+	# acknowledged as soon as its samples are queued. Every sample of a source
+	# goes to the same worker, so each pipeline still sees its samples in
+	# order. With a full queue, the overflow policy decides: coalesce replaces
+	# a sample of the same source still waiting with the newer one (rates and
+	# lags only need the latest offsets) and drops other new samples, drop
+	# always drops new samples, and block makes the submitting connection wait,
+	# which pushes back on its monitor through TCP.
+	def __init__(self, compute, num_workers=NUM_WORKERS, queue_size=QUEUE_SIZE,
+				 policy='coalesce', stats=None):
+		self.compute = compute	# compute(source, *args) on a worker thread
+		self.queue_size = queue_size
+		self.policy = policy
+		self.stats = stats
+		self.closed = False
+		self.workers = [Worker(self, num) for num in range(num_workers)]
+
+	def submit(self, source, *args):
+		# Returns whether the sample will be computed (possibly coalesced)
+		worker = self.workers[hash(source) % len(self.workers)]
+		with worker.cond:
+			full = self.queue_size <= len(worker.pending)
+			entry = worker.queued.get(source)
+			if full and entry is not None and self.policy == 'coalesce':
+				entry[1] = args
+				worker.coalesced += 1
+				return True
+			while self.queue_size <= len(worker.pending) or self.closed:
+				if self.policy != 'block' or self.closed:
+					worker.dropped += 1
+					return False
+				worker.cond.wait()
+			entry = [source, args, time.time()]
+			worker.pending.append(entry)
+			worker.queued[source] = entry
+			worker.cond.notify_all()
+		return True
+
+	def close(self):
+		# Samples still waiting are dropped; the ones being computed finish.
+		# Called from a signal handler, which may have interrupted a submit()
+		# holding a worker's lock, so the wait for the workers is bounded.
+		self.closed = True
+		for worker in self.workers:
+			with worker.cond:
+				worker.cond.notify_all()
+		for worker in self.workers:
+			worker.join(CLOSE_TIMEOUT_SEC)
+
+	def depth(self):
+		return sum([len(worker.pending) for worker in self.workers])
+
+	def dropped(self):
+		return sum([worker.dropped for worker in self.workers])
+
+	def coalesced(self):
+		return sum([worker.coalesced for worker in self.workers])
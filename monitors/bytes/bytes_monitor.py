@@ -0,0 +1,85 @@
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'metrics_server'))
+from metrics_client import MetricsClient, METRICS_SERVER_PORT
+from sampling import clock, fixed_rate, HOST_SEPARATOR
+
+# Constants
+NET_DEV = '/proc/net/dev'
+INTERFACE = 'eth0'
+MEASUREMENT_INTERVAL_SEC = 1.0
+DIRECTIONS = {'in': 'bytesin', 'out': 'bytesout'}
+RX_BYTES_FIELD = 0				# columns after 'eth0:' in /proc/net/dev
+TX_BYTES_FIELD = 8
+
+
+def read_counters(interface, path=NET_DEV):
+	# Returns (received bytes, transmitted bytes) of interface since boot; the
+	# kernel keeps these counters anyway, so sampling them costs one read no
+	# matter how much traffic there is, unlike capturing every packet
+	with open(path) as f:
+		for line in f:
+			(name, sep, fields) = line.partition(':')
+			if sep and name.strip() == interface:
+				fields = fields.split()
+				return (int(fields[RX_BYTES_FIELD]), int(fields[TX_BYTES_FIELD]))
+	raise ValueError('No interface {} in {}'.format(interface, path))
+
+def rates(last, current, elapsed_sec):
+	# Bytes per second between two samples of (rx, tx); None for a counter
+	# that went backwards (wrapped or reset with the interface)
+	return [float(c - l) / elapsed_sec if l <= c else None for (l, c) in zip(last, current)]
+
+def run_monitor(interface, directions, interval_sec, host=None, client=None):
+	# Samples at a fixed rate like the offsets monitor; samples go to the
+	# metrics server through client, or to stdout without one. With a host,
+	# samples are tagged as bytesin@<host> so the server sums the brokers.
+	last = read_counters(interface)
+	last_time = clock()
+	for tick in fixed_rate(interval_sec, immediately=False):
+		(current, now) = (read_counters(interface), clock())
+		(bytesin, bytesout) = rates(last, current, now - last_time)
+		(last, last_time) = (current, now)
+		vals = {}
+		tag = HOST_SEPARATOR + host if host is not None else ''
+		if 'in' in directions and bytesin is not None:
+			vals[DIRECTIONS['in'] + tag] = bytesin
+		if 'out' in directions and bytesout is not None:
+			vals[DIRECTIONS['out'] + tag] = bytesout
+		if len(vals) == 0:
+			continue
+		if client is not None:
+			client.set(vals)
+			if not client.flush():
+				print('Could not deliver all samples to the metrics server')
+		else:
+			print(json.dumps(vals))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-i', '--interface', default=INTERFACE, type=str)
+	parser.add_argument('-d', '--direction', nargs='+', default=sorted(DIRECTIONS), choices=sorted(DIRECTIONS),
+						help='report bytesin, bytesout or both')
+	parser.add_argument('--interval_sec', default=MEASUREMENT_INTERVAL_SEC, type=float)
+	parser.add_argument('--host', type=str,
+						help='tag samples with this broker name, e.g. $(hostname)')
+	parser.add_argument('-s', '--server_host', type=str,
+						help='push samples to this metrics server instead of printing them')
+	parser.add_argument('--server_port', default=METRICS_SERVER_PORT, type=int)
+	args = parser.parse_args()
+	print('Arguments: {}'.format(vars(args)))
+
+	try:
+		read_counters(args.interface)
+	except (IOError, ValueError) as ex:
+		sys.exit(str(ex))
+
+	client = None
+	if args.server_host is not None:
+		client = MetricsClient(args.server_host, args.server_port)
+
+	# infinite loop
+	run_monitor(args.interface, args.direction, args.interval_sec, args.host, client)
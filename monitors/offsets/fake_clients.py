@@ -0,0 +1,87 @@
+import json
+import math
+import time
+from kafka.common import OffsetResponsePayload
+from kazoo.exceptions import NoNodeError
+
+# Constants
+FAKE_TOPICS = ['test', 'flights', 'clicks']
+FAKE_PARTITIONS = 8
+FAKE_MSGS_PER_SEC = 1000		# per partition
+FAKE_LAG_PERIOD_SEC = 120		# the consumer falls behind and catches up within this period
+
+
+class FakeCluster(object):
+	# Offsets of a simulated cluster, as functions of time: producers append to
+	# every partition at a steady rate and every group's consumer wanders
+	# behind them, so lags and wait times move like on a real cluster
+	def __init__(self, topics, group_ids, num_partitions=FAKE_PARTITIONS,
+				 msgs_per_sec=FAKE_MSGS_PER_SEC):
+		self.topics = topics
+		self.group_ids = group_ids
+		self.num_partitions = num_partitions
+		self.msgs_per_sec = msgs_per_sec
+		self.start_time = time.time()
+
+	def latest_offset(self, topic, partition):
+		elapsed = time.time() - self.start_time
+		return int(self.msgs_per_sec * (1 + self.topics.index(topic)) * (elapsed + partition))
+
+	def committed_offset(self, topic, group_id, partition):
+		elapsed = time.time() - self.start_time
+		phase = 2 * math.pi * elapsed / FAKE_LAG_PERIOD_SEC + partition + self.group_ids.index(group_id)
+		lag = int(self.msgs_per_sec * (1 + self.topics.index(topic)) * (1.0 + math.sin(phase)))
+		return max(0, self.latest_offset(topic, partition) - lag)
+
+
+class FakeSimpleClient(object):
+	# Stand-in for kafka.SimpleClient answering offset requests from a FakeCluster
+	def __init__(self, cluster):
+		self.cluster = cluster
+		self.topic_partitions = dict((topic, dict((p, None) for p in range(cluster.num_partitions)))
+									 for topic in cluster.topics)
+
+	def send_offset_request(self, payloads):
+		return [OffsetResponsePayload(r.topic, r.partition, 0,
+									  [self.cluster.latest_offset(r.topic, r.partition)])
+				for r in payloads]
+
+	def close(self):
+		pass
+
+
+class FakeAsyncResult(object):
+	def __init__(self, value=None, exception=None):
+		self.value = value
+		self.exception = exception
+
+	def get(self, block=True, timeout=None):
+		if self.exception is not None:
+			raise self.exception
+		return self.value
+
+
+class FakeKazooClient(object):
+	# Stand-in for kazoo.client.KazooClient serving committed offsets from a
+	# FakeCluster at /<topic>/<group>/partition_<n>
+	def __init__(self, cluster):
+		self.cluster = cluster
+
+	def start(self):
+		pass
+
+	def stop(self):
+		pass
+
+	def get_async(self, path):
+		try:
+			(topic, group_id, partition) = path.strip('/').split('/')
+			partition = int(partition[len('partition_'):])
+		except ValueError:
+			return FakeAsyncResult(exception=NoNodeError(path))
+		if (topic not in self.cluster.topics or group_id not in self.cluster.group_ids or
+			self.cluster.num_partitions <= partition):
+			return FakeAsyncResult(exception=NoNodeError(path))
+		offset = self.cluster.committed_offset(topic, group_id, partition)
+		data = json.dumps({'partition': partition, 'offset': offset})
+		return FakeAsyncResult((data, None))
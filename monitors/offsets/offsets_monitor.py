@@ -1,13 +1,20 @@
 import argparse
 import json
+import os
+import re
 import sys
 import time
 from kazoo.client import KazooClient
 from kazoo.client import KazooState
+from kazoo.exceptions import NoNodeError
 from kafka import SimpleClient
 from kafka.protocol.offset import OffsetRequest, OffsetResetStrategy
 from kafka.common import OffsetRequestPayload
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'metrics_server'))
+from metrics_client import MetricsClient, METRICS_SERVER_PORT
+from sampling import fixed_rate
+
 # Constants
 MEASUREMENT_INTERVAL_SEC = 3
 # KAFKA_HOST = 'kafka1:9092'
@@ -16,97 +23,156 @@ KAFKA_HOST = 'localhost:9092'
 ZK_HOST = 'localhost:2181'
 
 class KafkaClient(object):
-	def __init__(self, kafka_host, topic, group_id):
-		self.client = SimpleClient(kafka_host)
-		self.topic = topic
-		try:
-			self.partitions = self.client.topic_partitions[topic]
-		except KeyError as ex:
-			print('KeyError: {}'.format(ex))
-			self.partitions = None
-		self.group_id = group_id
+	# One SimpleClient for all monitored topics
+	def __init__(self, kafka_host, topics=None, topic_pattern=None, client=None):
+		self.client = client if client is not None else SimpleClient(kafka_host)
+		if topic_pattern is not None:
+			topics = sorted([t for t in self.client.topic_partitions if re.match(topic_pattern, t)])
+		self.partitions = {}	# topic -> {partition: metadata}
+		for topic in topics:
+			try:
+				self.partitions[topic] = self.client.topic_partitions[topic]
+			except KeyError as ex:
+				print('KeyError: {}'.format(ex))
 
 	def close(self):
 		self.client.close()
 
 	def get_latest_offsets(self):
-		request = [OffsetRequestPayload(self.topic, p, -1, 1) for p in self.partitions.keys()]
-		response = self.client.send_offset_request(request)	
-		offsets = {r.partition: r.offsets[0] for r in response} # build dictionary
+		# A single call for all topics: SimpleClient groups the payloads by
+		# partition leader and sends one request per broker
+		request = [OffsetRequestPayload(topic, p, -1, 1)
+				   for topic in self.partitions for p in self.partitions[topic].keys()]
+		response = self.client.send_offset_request(request)
+		offsets = dict((topic, {}) for topic in self.partitions)
+		for r in response:
+			offsets[r.topic][r.partition] = r.offsets[0]
 		return offsets
 
 class ZkClient(object):
-	def __init__(self, zk_host, topic, partitions, group_id):
-		self.client = KazooClient(hosts=zk_host, read_only=True)
+	# One KazooClient for all monitored (topic, group) pairs
+	def __init__(self, zk_host, client=None):
+		self.client = client if client is not None else KazooClient(hosts=zk_host, read_only=True)
 		self.client.start()
-		self.topic = topic
-		self.partitions = partitions
-		self.group_id = group_id
 
 	def close(self):
 		self.client.stop()
 
-	def get_committed_offsets(self):
-		zk_path = '/' + self.topic + '/' + self.group_id
+	def request_committed_offsets(self, topic, group_id, partitions):
+		# Issues the reads of all partitions at once instead of one round-trip
+		# after another; collect_committed_offsets() waits for the answers
+		zk_path = '/' + topic + '/' + group_id
+		return dict((p, self.client.get_async(zk_path + '/partition_' + str(p)))
+					for p in partitions.keys())
+
+	def collect_committed_offsets(self, requests):
 		offsets = {}
-		for p in self.partitions.keys():
-			path = zk_path + '/partition_' + str(p)
-			if self.client.exists(path):
-				data, stat = self.client.get(path)
-				json_data = json.loads(data)
-				if json_data['partition'] == p:
-					offsets[p] = json_data['offset']
-				else:
-					print('Requested and received partitions do not match: {} vs. {}'. \
-						  format(json_data['partition'], p))
+		for p in requests:
+			try:
+				data, stat = requests[p].get()
+			except NoNodeError:
+				continue
+			json_data = json.loads(data)
+			if json_data['partition'] == p:
+				offsets[p] = json_data['offset']
+			else:
+				print('Requested and received partitions do not match: {} vs. {}'. \
+					  format(json_data['partition'], p))
 		return offsets
+
+	def get_committed_offsets(self, topic, group_id, partitions):
+		return self.collect_committed_offsets(self.request_committed_offsets(topic, group_id, partitions))
 	
 
-def run_monitor(kafka, zk, interval_sec):
-	while True:
-		latest_offsets = kafka.get_latest_offsets()
-		committed_offsets = zk.get_committed_offsets()
+def collect_offsets(kafka, zk, pairs):
+	# Returns {(topic, group_id): partitions}; ZooKeeper answers the committed
+	# offset reads of every pair while Kafka is queried
+	requests = dict(((topic, group_id), zk.request_committed_offsets(topic, group_id, kafka.partitions[topic]))
+					for (topic, group_id) in pairs)
+	# could not get timestamp from kafka -> use reeceived timestamp at monitor
+	timestamp = time.time()
+	latest_offsets = kafka.get_latest_offsets()
+	offsets = {}
+	for (topic, group_id) in pairs:
+		committed_offsets = zk.collect_committed_offsets(requests[(topic, group_id)])
+		latest = latest_offsets[topic]
 		partitions = {}
-		for p in kafka.partitions.keys():
-			if p in committed_offsets:
-				# could not get timestamp from kafka -> use reeceived timestamp at monitor
-				partitions['partition_' + str(p)] = {'latest': latest_offsets[p], 
+		for p in kafka.partitions[topic].keys():
+			if p in committed_offsets and p in latest:
+				partitions['partition_' + str(p)] = {'latest': latest[p], 
 													 'committed': committed_offsets[p],
-													 'lag': latest_offsets[p] - committed_offsets[p],
-													 'timestamp': time.time()}
-		offsets = {'offsets': partitions}
-		print(json.dumps(offsets))
-		time.sleep(interval_sec)
+													 'lag': latest[p] - committed_offsets[p],
+													 'timestamp': timestamp}
+		offsets[(topic, group_id)] = partitions
+	return offsets
+
+def offsets_var(topic, group_id, namespaced):
+	return '/'.join(['offsets', topic, group_id]) if namespaced else 'offsets'
+
+def run_monitor(kafka, zk, pairs, interval_sec, namespaced, client=None):
+	# Samples at a fixed rate: the time spent collecting is taken out of the
+	# sleep, and ticks missed by a slow collection are skipped, not bunched up.
+	# Samples go to the metrics server through client, or to stdout without one.
+	for tick in fixed_rate(interval_sec):
+		offsets = collect_offsets(kafka, zk, pairs)
+		for (topic, group_id) in pairs:
+			# pairs of a topic and a group not consuming it have nothing to report
+			if 0 < len(offsets[(topic, group_id)]) or len(pairs) == 1:
+				vals = {offsets_var(topic, group_id, namespaced): offsets[(topic, group_id)]}
+				if client is not None:
+					client.set(vals)
+				else:
+					print(json.dumps(vals))
+		if client is not None and not client.flush():
+			print('Could not deliver all samples to the metrics server')
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-k', '--kafka_host', default=KAFKA_HOST, type=str)
 	parser.add_argument('-z', '--zk_host', default=ZK_HOST, type=str)
-	parser.add_argument('-t', '--topic', required=True, type=str)
-	parser.add_argument('-g', '--group_id', required=True, type=str)
-	parser.add_argument('-i', '--interval_sec', default=MEASUREMENT_INTERVAL_SEC, type=int)
+	topic_args = parser.add_mutually_exclusive_group(required=True)
+	topic_args.add_argument('-t', '--topic', nargs='+', type=str)
+	topic_args.add_argument('-p', '--topic_pattern', type=str,
+							help='monitor every topic whose name matches this regular expression')
+	parser.add_argument('-g', '--group_id', nargs='+', required=True, type=str)
+	parser.add_argument('-i', '--interval_sec', default=MEASUREMENT_INTERVAL_SEC, type=float)
+	parser.add_argument('-n', '--namespaced', action='store_true',
+						help='report as offsets/<topic>/<group> so the metrics server keeps '
+						'per-topic/group derived values (implied by several topics or groups)')
+	parser.add_argument('-f', '--fake', action='store_true',
+						help='read offsets from a simulated cluster instead of Kafka and ZooKeeper')
+	parser.add_argument('-s', '--server_host', type=str,
+						help='push samples to this metrics server instead of printing them')
+	parser.add_argument('--server_port', default=METRICS_SERVER_PORT, type=int)
 	args = parser.parse_args()
 	print('Arguments: {}'.format(vars(args)))
 
-	kafka = KafkaClient(args.kafka_host, args.topic, args.group_id)
-	if kafka.partitions is None:
-		sys.exit('Partitions for requested topic \'{}\' do not exist'.format(args.topic))
-	zk = ZkClient(args.zk_host, args.topic, kafka.partitions, args.group_id)
+	(kafka_client, zk_client) = (None, None)
+	if args.fake:
+		from fake_clients import FakeCluster, FakeKazooClient, FakeSimpleClient, FAKE_TOPICS
+		cluster = FakeCluster(args.topic if args.topic is not None else FAKE_TOPICS, args.group_id)
+		(kafka_client, zk_client) = (FakeSimpleClient(cluster), FakeKazooClient(cluster))
 
-	# infinite loop
-	run_monitor(kafka, zk, args.interval_sec)
-
-	# never come here
-	kafka_close(kafka)
-	zk_close(zk)
+	kafka = KafkaClient(args.kafka_host, args.topic, args.topic_pattern, kafka_client)
+	if len(kafka.partitions) == 0:
+		sys.exit('Partitions for requested topics \'{}\' do not exist'.
+				 format(args.topic if args.topic is not None else args.topic_pattern))
+	zk = ZkClient(args.zk_host, zk_client)
 
-	
+	# every group against every topic
+	pairs = [(topic, group_id) for topic in sorted(kafka.partitions) for group_id in args.group_id]
+	namespaced = args.namespaced or 1 < len(pairs)
 
+	client = None
+	if args.server_host is not None:
+		# binary: the partition fields travel as arrays instead of JSON text
+		client = MetricsClient(args.server_host, args.server_port, binary=True)
 
-	
-
-
-
-
-	
+	# infinite loop
+	run_monitor(kafka, zk, pairs, args.interval_sec, namespaced, client)
 
+	# never come here
+	kafka.close()
+	zk.close()
+	if client is not None:
+		client.close()